@@ -1,12 +1,17 @@
 import streamlit as st
 import pandas as pd
-from datetime import datetime
+import numpy as np
+from datetime import datetime, date
+from contextlib import contextmanager
 import psycopg2
-import psycopg2.extras
-import plotly.express as px
+import psycopg2.pool
 import io
+import csv
+import os
 import re
-import numpy as np
+import threading
+import bcrypt
+import hmac
 
 # ==============================
 # 0. CONFIGURAÇÃO DE ESTILO E TEMA (SINAPSIS)
@@ -26,6 +31,14 @@ COR_FUNDO_SIDEBAR = COR_PRIMARIA
 
 SINAPSIS_PALETTE = [COR_SECUNDARIA, COR_PRIMARIA, COR_CINZA, "#888888", "#C0C0C0"]
 
+@st.cache_resource(show_spinner=False)
+def carregar_css():
+    """Bloco <style> pronto, montado uma vez por processo a partir de static/app.css (cores como variáveis CSS)."""
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "static", "app.css"), encoding="utf-8") as f:
+        css = f.read()
+    return (f"<style>:root {{ --cor-sidebar: {COR_FUNDO_SIDEBAR}; --cor-secundaria: {COR_SECUNDARIA}; "
+            f"--cor-fundo-app: {COR_FUNDO_APP}; --cor-cinza: {COR_CINZA}; }}\n{css}</style>")
+
 # URL DO LOGO (Versão RAW)
 LOGO_URL = "https://github.com/Bdmconsultoria/dap/raw/main/logo-branco%202.png" 
 
@@ -47,133 +60,263 @@ except KeyError:
 # ==============================
 # 2. Conexão com PostgreSQL
 # ==============================
+class ConexaoPreparada(psycopg2.extensions.connection):
+    """Conexão que registra os prepared statements já criados na sessão."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.preparados = set()
+        self.autocommit = True # Escrita de um statement só: sem BEGIN/COMMIT extras; lotes usam transacao()
+
+def executar_preparado(cursor, nome, sql, params):
+    """Faz o PREPARE na primeira chamada da conexão; nas demais só EXECUTE (sem parse/plan)."""
+    conn = cursor.connection
+    marcadores = ", ".join(["%s"] * len(params))
+    if nome in conn.preparados:
+        cursor.execute(f"EXECUTE {nome} ({marcadores})", params)
+        return
+    # PREPARE e primeiro EXECUTE vão juntos no mesmo round-trip
+    try:
+        cursor.execute(f"PREPARE {nome} AS {sql.replace('%', '%%')}; EXECUTE {nome} ({marcadores})", params)
+    except psycopg2.Error as e:
+        # O rollback não desfaz o PREPARE: se a falha foi no EXECUTE (erro de dados), o statement já existe na sessão
+        if e.pgcode and e.pgcode[:2] not in ('42', '25'): conn.preparados.add(nome)
+        raise
+    conn.preparados.add(nome)
+
+class PoolComEspera(psycopg2.pool.ThreadedConnectionPool):
+    """Pool que espera uma conexão ser devolvida em vez de falhar na hora quando todas estão em uso."""
+    def __init__(self, minconn, maxconn, *args, espera=10, **kwargs):
+        super().__init__(minconn, maxconn, *args, **kwargs)
+        self._vagas = threading.BoundedSemaphore(maxconn)
+        self._espera = espera
+
+    def getconn(self, key=None):
+        if not self._vagas.acquire(timeout=self._espera):
+            raise psycopg2.pool.PoolError("connection pool exhausted")
+        try:
+            return super().getconn(key)
+        except Exception:
+            self._vagas.release()
+            raise
+
+    def putconn(self, conn=None, key=None, close=False):
+        # Só libera a vaga se a conexão estava de fato emprestada (evita liberar duas vezes)
+        emprestada = conn is not None and id(conn) in self._rused
+        try:
+            super().putconn(conn, key, close)
+        finally:
+            if emprestada: self._vagas.release()
+
+@st.cache_resource(show_spinner=False)
+def get_pool():
+    """Pool de conexões por processo: evita o handshake TCP+TLS a cada consulta."""
+    return PoolComEspera(1, 8, connection_factory=ConexaoPreparada, **DB_PARAMS)
+
 def get_db_connection():
     if not DB_PARAMS: return None 
     try:
-        conn = psycopg2.connect(**DB_PARAMS)
+        conn = get_pool().getconn()
         return conn
+    except psycopg2.pool.PoolError:
+        # Nenhuma conexão foi devolvida dentro da espera: avisa em vez de seguir calado
+        st.error("Todas as conexões com o banco estão em uso. Tente novamente em instantes.")
+        return None
     except Exception as e:
         return None
 
+def release_db_connection(conn):
+    """Devolve a conexão ao pool (o pool faz rollback de transações abertas)."""
+    try:
+        get_pool().putconn(conn, close=bool(conn.closed))
+    except Exception:
+        conn.close()
+
+@contextmanager
+def transacao(conn):
+    """Abre uma transação explícita numa conexão em autocommit (escritas com vários statements)."""
+    conn.autocommit = False
+    try:
+        yield
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.autocommit = True
+
+@contextmanager
+def db_conn():
+    """Empresta uma conexão do pool pelo bloco `with` e sempre a devolve; None se não houver banco."""
+    conn = get_db_connection()
+    try:
+        yield conn
+    finally:
+        if conn is not None: release_db_connection(conn)
+
 # ==============================
 # 3. Setup do Banco
 # ==============================
+@st.cache_resource(show_spinner=False)
 def setup_db():
-    conn = get_db_connection()
-    if conn is None: return
-    try:
-        with conn.cursor() as cursor:
-            # Tabela USUARIOS
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS usuarios (
-                    usuario VARCHAR(50) PRIMARY KEY,
-                    senha VARCHAR(50) NOT NULL,
-                    admin BOOLEAN DEFAULT FALSE,
-                    email VARCHAR(255)
-                );
-            """)
-            
-            # Tabela ATIVIDADES
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS atividades (
-                    id SERIAL PRIMARY KEY,
-                    usuario VARCHAR(50) REFERENCES usuarios(usuario),
-                    data DATE NOT NULL,
-                    mes INTEGER NOT NULL,
-                    ano INTEGER NOT NULL,
-                    descricao VARCHAR(255) NOT NULL,
-                    projeto VARCHAR(255) NOT NULL,
-                    porcentagem INTEGER NOT NULL,
-                    observacao TEXT,
-                    status VARCHAR(50) DEFAULT 'Pendente' 
-                );
-            """)
-            
-            # Coluna status
-            try:
-                cursor.execute("SELECT 1 FROM information_schema.columns WHERE table_name='atividades' AND column_name='status';")
-                if not cursor.fetchone():
-                    cursor.execute("ALTER TABLE atividades ADD COLUMN status VARCHAR(50) DEFAULT 'Pendente';")
-                    conn.commit()
-            except Exception:
-                conn.rollback() 
-            
-            # Tabela HIERARQUIA
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS hierarquia (
-                    gerente VARCHAR(50) REFERENCES usuarios(usuario),
-                    subordinado VARCHAR(50) REFERENCES usuarios(usuario),
-                    PRIMARY KEY (gerente, subordinado),
-                    CHECK (gerente != subordinado)
-                );
-            """)
-            
-            # Adiciona a coluna email se ela não existir
-            try:
-                cursor.execute("SELECT 1 FROM information_schema.columns WHERE table_name='usuarios' AND column_name='email';")
-                if not cursor.fetchone():
-                    cursor.execute("ALTER TABLE usuarios ADD COLUMN email VARCHAR(255);")
-                    conn.commit()
-            except Exception:
-                conn.rollback()
-
-            conn.commit()
-    except Exception as e:
-        st.error(f"Erro no setup DB: {e}")
-    finally:
-        conn.close()
+    """Cria/migra o schema uma única vez por processo (não a cada rerun)."""
+    with db_conn() as conn:
+        if conn is None: return False
+        try:
+            with transacao(conn), conn.cursor() as cursor:
+                # Todo o DDL é idempotente e vai em um único round-trip / transação
+                cursor.execute("""
+                    -- Tabela USUARIOS
+                    CREATE TABLE IF NOT EXISTS usuarios (
+                        usuario VARCHAR(50) PRIMARY KEY,
+                        senha VARCHAR(128) NOT NULL,
+                        admin BOOLEAN DEFAULT FALSE,
+                        email VARCHAR(255)
+                    );
+
+                    -- Tabela ATIVIDADES
+                    CREATE TABLE IF NOT EXISTS atividades (
+                        id SERIAL PRIMARY KEY,
+                        usuario VARCHAR(50) REFERENCES usuarios(usuario),
+                        data DATE NOT NULL,
+                        mes INTEGER NOT NULL,
+                        ano INTEGER NOT NULL,
+                        descricao VARCHAR(255) NOT NULL,
+                        projeto VARCHAR(255) NOT NULL,
+                        porcentagem INTEGER NOT NULL,
+                        observacao TEXT,
+                        status VARCHAR(50) NOT NULL DEFAULT 'Pendente'
+                    );
+
+                    -- Tabela HIERARQUIA
+                    CREATE TABLE IF NOT EXISTS hierarquia (
+                        gerente VARCHAR(50) REFERENCES usuarios(usuario),
+                        subordinado VARCHAR(50) REFERENCES usuarios(usuario),
+                        PRIMARY KEY (gerente, subordinado),
+                        CHECK (gerente != subordinado)
+                    );
+
+                    -- Colunas adicionadas depois da criação original das tabelas
+                    ALTER TABLE atividades ADD COLUMN IF NOT EXISTS status VARCHAR(50) DEFAULT 'Pendente';
+                    -- status nunca nulo (uma vez só, em bases antigas): leituras dispensam COALESCE
+                    DO $$ BEGIN
+                        IF NOT (SELECT attnotnull FROM pg_attribute WHERE attrelid = 'atividades'::regclass AND attname = 'status') THEN
+                            UPDATE atividades SET status = 'Pendente' WHERE status IS NULL;
+                            ALTER TABLE atividades ALTER COLUMN status SET NOT NULL;
+                        END IF;
+                    END $$;
+                    -- Só os três status que a aplicação conhece (o STATUS_DTYPE do pandas depende disso)
+                    DO $$ BEGIN
+                        IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conrelid = 'atividades'::regclass AND conname = 'atividades_status_check') THEN
+                            ALTER TABLE atividades ADD CONSTRAINT atividades_status_check CHECK (status IN ('Pendente', 'Aprovado', 'Rejeitado')) NOT VALID;
+                            BEGIN
+                                ALTER TABLE atividades VALIDATE CONSTRAINT atividades_status_check;
+                            EXCEPTION WHEN check_violation THEN NULL; -- Base antiga com outros valores: a regra vale só para novas escritas
+                            END;
+                        END IF;
+                    END $$;
+                    ALTER TABLE usuarios ADD COLUMN IF NOT EXISTS email VARCHAR(255);
+                    -- Hash bcrypt (60 chars) não cabe no VARCHAR(50) original; o ALTER (lock exclusivo) só roda em base antiga
+                    DO $$ BEGIN
+                        IF (SELECT character_maximum_length FROM information_schema.columns
+                            WHERE table_schema = current_schema() AND table_name = 'usuarios' AND column_name = 'senha') < 128 THEN
+                            ALTER TABLE usuarios ALTER COLUMN senha TYPE VARCHAR(128);
+                        END IF;
+                    END $$;
+
+                    -- Consultas por usuário/mês (Lançar/Minhas Atividades, ajuste de horas, soma do mês);
+                    -- o INCLUDE cobre as colunas projetadas e permite index-only scan
+                    DROP INDEX IF EXISTS idx_atividades_usuario_ano_mes;
+                    CREATE INDEX IF NOT EXISTS idx_atividades_usuario_ano_mes_cob ON atividades (usuario, ano, mes)
+                        INCLUDE (id, data, descricao, projeto, porcentagem, status);
+                """)
+
+                # Compressão LZ4 no TOAST de observacao (PG 14+ compilado com lz4); sem suporte, fica o pglz padrão
+                cursor.execute("SAVEPOINT compressao;")
+                try:
+                    cursor.execute("""
+                        DO $$ BEGIN
+                            IF (SELECT attcompression FROM pg_attribute WHERE attrelid = 'atividades'::regclass AND attname = 'observacao') <> 'l' THEN
+                                ALTER TABLE atividades ALTER COLUMN observacao SET COMPRESSION lz4;
+                            END IF;
+                        END $$;
+                    """)
+                except psycopg2.Error:
+                    cursor.execute("ROLLBACK TO SAVEPOINT compressao;")
+                return True
+        except Exception as e:
+            st.error(f"Erro no setup DB: {e}")
+            return False
 
-if DB_PARAMS:
-    setup_db()
+if DB_PARAMS and not setup_db():
+    setup_db.clear() # Falhou: tenta de novo no próximo rerun
 
 # ==============================
 # 4. CRUD, Consultas e Lógica de Cálculo
 # ==============================
 
+# Linhas por statement no execute_values: um INSERT/UPDATE multi-VALUES por página (não é o execute_batch,
+# em que páginas pequenas ajudam); lotes abaixo de COPY_LIMIAR cabem em um ou dois statements
+BULK_PAGE_SIZE = 500
+
+# --- INVALIDAÇÃO (toda escrita em atividades passa por aqui) ---
+def invalidar_atividades():
+    carregar_atividades.clear()
+    carregar_atividades_time.clear()
+
+# --- SENHAS (bcrypt: núcleo em C, libera o GIL durante o hash) ---
+BCRYPT_ROUNDS = 12
+SENHA_PADRAO = '123' # Senha inicial dos usuários criados em lote (limpeza de nomes)
+
+def gerar_hash_senha(senha):
+    return bcrypt.hashpw(senha.encode('utf-8')[:72], bcrypt.gensalt(BCRYPT_ROUNDS)).decode('ascii')
+
+def verificar_senha(senha, armazenada):
+    """Retorna (confere, precisa_rehash). Senhas legadas em texto puro são aceitas e migradas no login."""
+    if armazenada.startswith(('$2a$', '$2b$', '$2y$')):
+        ok = bcrypt.checkpw(senha.encode('utf-8')[:72], armazenada.encode('ascii'))
+        return ok, ok and int(armazenada.split('$')[2]) != BCRYPT_ROUNDS
+    ok = hmac.compare_digest(armazenada.encode('utf-8'), senha.encode('utf-8')) # Tempo constante
+    return ok, ok
+
 def salvar_usuario(usuario, senha, admin=False):
-    conn = get_db_connection()
-    if conn is None: return False
-    try:
-        with conn.cursor() as cursor:
-            cursor.execute("""
-                INSERT INTO usuarios (usuario, senha, admin) VALUES (%s, %s, %s)
-                ON CONFLICT (usuario) DO NOTHING;
-            """, (usuario, senha, admin))
-            conn.commit()
-            carregar_dados.clear() # Limpa cache de usuários
-            return True
-    except Exception:
-        return False
-    finally:
-        conn.close()
+    with db_conn() as conn:
+        if conn is None: return False
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("""
+                    INSERT INTO usuarios (usuario, senha, admin) VALUES (%s, %s, %s)
+                    ON CONFLICT (usuario) DO NOTHING;
+                """, (usuario, gerar_hash_senha(senha), admin))
+                carregar_usuarios.clear() # Limpa cache de usuários
+                return True
+        except Exception:
+            return False
 
 def validar_login(usuario, senha):
-    conn = get_db_connection()
-    if conn is None: return False, False
-    try:
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT senha, admin FROM usuarios WHERE usuario = %s;", (usuario,))
-            result = cursor.fetchone()
-            if result and result[0] == senha:
+    with db_conn() as conn:
+        if conn is None: return False, False
+        try:
+            with conn.cursor() as cursor:
+                executar_preparado(cursor, "sel_login", "SELECT senha, admin FROM usuarios WHERE usuario = $1", (usuario,))
+                result = cursor.fetchone()
+                if not result: return False, False
+                ok, precisa_rehash = verificar_senha(senha, result[0])
+                if not ok: return False, False
+                if precisa_rehash:
+                    cursor.execute("UPDATE usuarios SET senha = %s WHERE usuario = %s;", (gerar_hash_senha(senha), usuario))
                 return True, result[1]
+        except Exception:
             return False, False
-    except Exception:
-        return False, False
-    finally:
-        conn.close()
 
 def alterar_senha(usuario, nova_senha):
-    conn = get_db_connection()
-    if conn is None: return False
-    try:
-        with conn.cursor() as cursor:
-            cursor.execute("UPDATE usuarios SET senha = %s WHERE usuario = %s;", (nova_senha, usuario))
-            conn.commit()
-            return True
-    except Exception:
-        return False
-    finally:
-        conn.close()
+    with db_conn() as conn:
+        if conn is None: return False
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("UPDATE usuarios SET senha = %s WHERE usuario = %s;", (gerar_hash_senha(nova_senha), usuario))
+                return True
+        except Exception:
+            return False
 
 def extrair_hora_bruta(observacao):
     """Extrai metadado [HORA:X|OBS]"""
@@ -186,16 +329,20 @@ def extrair_hora_bruta(observacao):
             pass
     return 0.0, observacao.strip()
 
+def limpar_observacoes(serie):
+    """extrair_hora_bruta(x)[1] para a coluna inteira de uma vez (str.extract, sem apply por linha)."""
+    serie = serie.fillna('').astype(str)
+    return serie.str.extract(r'\[HORA:\d+\.?\d*\|(.*)\]', flags=re.DOTALL)[0].fillna(serie).str.strip()
+
 def atualizar_porcentagem_atividade(conn, atividade_id, nova_porcentagem):
     """Atualiza porcentagem usando uma conexão aberta existente"""
     with conn.cursor() as cursor:
         cursor.execute("UPDATE atividades SET porcentagem = %s WHERE id = %s;", (nova_porcentagem, atividade_id))
 
 # --- ALGORITMO DE CORREÇÃO DE ARREDONDAMENTO (99%/101%) ---
-def ajustar_arredondamento_horas(usuario, mes, ano):
-    conn = get_db_connection()
-    if not conn: return
-
+def ajustar_arredondamento_horas(conn, usuario, mes, ano):
+    """Recalcula os % do mês no modo horas usando a conexão de quem gravou (já em autocommit),
+    sem pegar uma segunda conexão do pool por escrita."""
     try:
         with conn.cursor() as cursor:
             cursor.execute("""
@@ -231,311 +378,357 @@ def ajustar_arredondamento_horas(usuario, mes, ano):
             lista_dados[idx_max]['novo_perc'] += diferenca
         
         update_count = 0
-        with conn.cursor() as cursor:
+        with transacao(conn):
             for item in lista_dados:
                 if item['novo_perc'] != item['perc_atual']:
                     atualizar_porcentagem_atividade(conn, item['id'], item['novo_perc'])
                     update_count += 1
         
         if update_count > 0:
-            conn.commit()
-            carregar_dados.clear() # Limpa cache após ajuste
+            invalidar_atividades() # Limpa cache após ajuste
             return True
         return False
 
 
     except Exception as e:
-        conn.rollback()
         st.error(f"Erro no ajuste de arredondamento: {e}")
         return False
-    finally:
-        conn.close()
-
-def calcular_porcentagem_existente(usuario, mes, ano, excluido_id=None):
-    conn = get_db_connection()
-    if conn is None: return 101
-    try:
-        with conn.cursor() as cursor:
-            query = "SELECT COALESCE(SUM(porcentagem), 0) FROM atividades WHERE usuario = %s AND mes = %s AND ano = %s AND status != 'Rejeitado'"
-            params = [usuario, mes, ano]
-            if excluido_id is not None:
-                query += " AND id != %s"
-                params.append(excluido_id)
-            cursor.execute(query + ";", params)
-            result = cursor.fetchone()
-            return result[0] if result else 0 
-    except Exception:
-        return 101 
-    finally:
-        conn.close()
 
-def salvar_atividade(usuario, mes, ano, descricao, projeto, porcentagem, observacao, atividade_id=None):
-    conn = get_db_connection()
-    if conn is None: return False
-    try:
-        with conn.cursor() as cursor:
-            data_db = datetime(year=ano, month=mes, day=1).date()
-            if atividade_id is None:
-                cursor.execute("""
+def salvar_atividades_em_massa(usuario, mes, ano, linhas, limite=None):
+    """Insere vários lançamentos do mesmo mês num único INSERT ... SELECT FROM unnest (um round-trip, um commit).
+    linhas = [(descricao, projeto, porcentagem, observacao)]; com `limite`, entram todos ou nenhum."""
+    if not linhas: return False
+    descricoes, projetos, porcentagens, observacoes = (list(c) for c in zip(*linhas))
+    with db_conn() as conn:
+        if conn is None: return False
+        try:
+            with transacao(conn), conn.cursor() as cursor:
+                if limite is not None:
+                    # Sob READ COMMITTED dois INSERTs simultâneos veriam a mesma soma: o lock por usuário/mês os enfileira
+                    cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s), %s);", (usuario, ano * 100 + mes))
+                executar_preparado(cursor, "ins_atividades_lote", """
                     INSERT INTO atividades (usuario, data, mes, ano, descricao, projeto, porcentagem, observacao)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s);
-                """, (usuario, data_db, mes, ano, descricao, projeto, porcentagem, observacao))
-            else:
-                cursor.execute("""
-                    UPDATE atividades SET data=%s, mes=%s, ano=%s, descricao=%s, projeto=%s, porcentagem=%s, observacao=%s
-                    WHERE id=%s;
-                """, (data_db, mes, ano, descricao, projeto, porcentagem, observacao, atividade_id))
-            conn.commit()
-        
-        ajustar_arredondamento_horas(usuario, mes, ano)
-        carregar_dados.clear() # Garante cache limpo
-        return True
-    except Exception as e:
-        st.error(f"Erro salvar: {e}")
-        return False
-    finally:
-        conn.close()
-
-def atualizar_atividade_completa(atividade_id, nova_descricao, novo_projeto, nova_porcentagem, nova_observacao):
-    conn = get_db_connection()
-    if conn is None: return False
-    try:
-        dados = None
-        with conn.cursor() as cursor:
-            cursor.execute("SELECT usuario, mes, ano FROM atividades WHERE id = %s;", (atividade_id,))
-            dados = cursor.fetchone()
-            if not dados: return False
-            usuario, mes, ano = dados
-
-            cursor.execute("""
-                UPDATE atividades SET descricao = %s, projeto = %s, porcentagem = %s, observacao = %s WHERE id = %s;
-            """, (nova_descricao, novo_projeto, nova_porcentagem, nova_observacao, atividade_id))
-            conn.commit()
-        
-        ajustar_arredondamento_horas(usuario, mes, ano)
-        carregar_dados.clear() # Garante cache limpo
-        return True
-    except Exception as e:
-        st.error(f"Erro atualizar completa: {e}")
-        return False
-    finally:
-        conn.close()
-
-def apagar_atividade(atividade_id):
-    conn = get_db_connection()
-    if conn is None: return False
-    dados = None
-    try:
-        with conn.cursor() as cursor:
-            # 1. Obter dados para ajuste (antes de apagar)
-            cursor.execute("SELECT usuario, mes, ano FROM atividades WHERE id = %s;", (atividade_id,))
-            dados = cursor.fetchone()
-
-            # 2. Deletar a atividade
-            cursor.execute("DELETE FROM atividades WHERE id = %s;", (atividade_id,))
-            conn.commit()
-            
-            # 3. Aplicar ajuste se houver dados e a exclusão foi bem-sucedida
-            if dados:
-                usuario, mes, ano = dados
-                ajustar_arredondamento_horas(usuario, mes, ano)
-                carregar_dados.clear() # Garante cache limpo
-                return True
-            return True # Deletou, mas não precisava de ajuste (ou não achou dados, o que é um sucesso na deleção)
-
-    except Exception:
-        conn.rollback()
-        return False
-    finally:
-        conn.close()
-    
-def atualizar_status_atividade(atividade_id, novo_status):
-    conn = get_db_connection()
-    if conn is None: return False
-    try:
-        with conn.cursor() as cursor:
-            cursor.execute("UPDATE atividades SET status = %s WHERE id = %s;", (novo_status, atividade_id))
-            conn.commit()
-            carregar_dados.clear() # Garante cache limpo
+                    SELECT $1::varchar, $2::date, $3::int, $4::int, n.descricao, n.projeto, n.porcentagem, n.observacao
+                    FROM unnest($5::varchar[], $6::varchar[], $7::int[], $8::text[]) AS n(descricao, projeto, porcentagem, observacao)
+                    WHERE $9::int IS NULL OR (SELECT COALESCE(SUM(porcentagem), 0) FROM atividades
+                                              WHERE usuario = $1 AND mes = $3 AND ano = $4 AND status != 'Rejeitado')
+                                             + (SELECT SUM(p) FROM unnest($7::int[]) AS p) <= $9::int
+                """, (usuario, date(ano, mes, 1), mes, ano, descricoes, projetos, [int(p) for p in porcentagens], observacoes, limite))
+                if cursor.rowcount == 0:
+                    st.error(f"Ultrapassa {limite}%.")
+                    return False
+
+            ajustar_arredondamento_horas(conn, usuario, mes, ano)
+            invalidar_atividades() # Garante cache limpo
             return True
-    except Exception:
-        return False
-    finally:
-        conn.close()
+        except Exception as e:
+            st.error(f"Erro salvar: {e}")
+            return False
+
+def aplicar_edicoes_atividades(alteracoes, ids_apagar):
+    """Grava as edições da tabela em uma transação: um UPDATE ... FROM (VALUES) e um DELETE ... ANY."""
+    from psycopg2.extras import execute_values # Import tardio: só carrega o módulo quando há escrita em lote
+    if not alteracoes and not ids_apagar: return False
+    with db_conn() as conn:
+        if conn is None: return False
+        try:
+            meses_afetados = set()
+            with transacao(conn), conn.cursor() as cursor:
+                if alteracoes:
+                    # Mesmo lock por usuário/mês do lançamento com limite: edições simultâneas não somam juntas além de 100%
+                    executar_preparado(cursor, "lock_meses_atividades", """
+                        SELECT pg_advisory_xact_lock(hashtext(m.usuario), m.ano * 100 + m.mes)
+                        FROM (SELECT DISTINCT usuario, mes, ano FROM atividades WHERE id = ANY($1::int[]) ORDER BY usuario, ano, mes) AS m
+                    """, ([int(a[0]) for a in alteracoes],))
+                    meses_afetados.update(execute_values(cursor, """
+                        UPDATE atividades AS a SET descricao = v.descricao, projeto = v.projeto, porcentagem = v.porcentagem, observacao = v.observacao
+                        FROM (VALUES %s) AS v (id, descricao, projeto, porcentagem, observacao)
+                        WHERE a.id = v.id RETURNING a.usuario, a.mes, a.ano;
+                    """, alteracoes, page_size=BULK_PAGE_SIZE, fetch=True))
+                if ids_apagar:
+                    executar_preparado(cursor, "del_atividades", "DELETE FROM atividades WHERE id = ANY($1::int[]) RETURNING usuario, mes, ano", ([int(i) for i in ids_apagar],))
+                    meses_afetados.update(cursor.fetchall())
+                if alteracoes and meses_afetados:
+                    # A checagem da tela usa o que foi lido antes; com o lock, o total é conferido de novo no banco
+                    executar_preparado(cursor, "sel_mes_acima_limite", """
+                        SELECT 1 FROM atividades
+                        WHERE (usuario, mes, ano) IN (SELECT * FROM unnest($1::varchar[], $2::int[], $3::int[])) AND status != 'Rejeitado'
+                        GROUP BY usuario, mes, ano HAVING SUM(porcentagem) > 100 LIMIT 1
+                    """, tuple(list(c) for c in zip(*meses_afetados)))
+                    if cursor.fetchone(): raise ValueError("o total do mês passaria de 100%.")
+
+            for usuario, mes, ano in meses_afetados:
+                ajustar_arredondamento_horas(conn, usuario, mes, ano)
+            invalidar_atividades() # Garante cache limpo
+            return True
+        except Exception as e:
+            st.error(f"Erro ao salvar edições: {e}")
+            return False
 
 def atualizar_status_em_massa(lista_ids, novo_status):
-    conn = get_db_connection()
-    if conn is None: return False
     if not lista_ids: return False
-    try:
-        with conn.cursor() as cursor:
-            ids_tuple = tuple(lista_ids)
-            cursor.execute(f"UPDATE atividades SET status = %s WHERE id IN %s;", (novo_status, ids_tuple))
-            conn.commit()
-            carregar_dados.clear() # Garante cache limpo
-            return True
-    except Exception as e:
-        conn.rollback()
-        st.error(f"Erro massa: {e}")
-        return False
-    finally:
-        conn.close()
+    with db_conn() as conn:
+        if conn is None: return False
+        try:
+            with conn.cursor() as cursor:
+                # Um único UPDATE para toda a seleção, com o plano reaproveitado entre cliques
+                executar_preparado(cursor, "upd_status_massa", "UPDATE atividades SET status = $1 WHERE id = ANY($2::int[])",
+                                   (novo_status, [int(i) for i in lista_ids]))
+                invalidar_atividades() # Garante cache limpo
+                return True
+        except Exception as e:
+            st.error(f"Erro massa: {e}")
+            return False
 
 def salvar_hierarquia(gerente, subordinado):
-    conn = get_db_connection()
-    if conn is None: return False
-    if gerente == subordinado: return False
-    try:
-        with conn.cursor() as cursor:
-            cursor.execute("""
-                INSERT INTO hierarquia (gerente, subordinado) VALUES (%s, %s)
-                ON CONFLICT (gerente, subordinado) DO NOTHING; 
-            """, (gerente, subordinado))
-            conn.commit()
-            carregar_hierarquia.clear() # Limpa cache de hierarquia
-            return True
-    except Exception:
-        return False
-    finally:
-        conn.close()
+    with db_conn() as conn:
+        if conn is None: return False
+        if gerente == subordinado: return False
+        try:
+            with conn.cursor() as cursor:
+                executar_preparado(cursor, "stmt_hier", """
+                    INSERT INTO hierarquia (gerente, subordinado) VALUES ($1, $2)
+                    ON CONFLICT (gerente, subordinado) DO NOTHING
+                """, (gerente, subordinado))
+                if cursor.rowcount: carregar_hierarquia.clear() # Duplicata (DO NOTHING) não muda nada: cache continua válido
+                return True
+        except Exception:
+            return False
 
 def apagar_hierarquia(gerente, subordinado):
-    conn = get_db_connection()
-    if conn is None: return False
-    try:
-        with conn.cursor() as cursor:
-            cursor.execute("DELETE FROM hierarquia WHERE gerente = %s AND subordinado = %s;", (gerente, subordinado))
-            conn.commit()
-            carregar_hierarquia.clear() # Limpa cache de hierarquia
-            return True
-    except Exception:
-        return False
-    finally:
-        conn.close()
+    with db_conn() as conn:
+        if conn is None: return False
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("DELETE FROM hierarquia WHERE gerente = %s AND subordinado = %s;", (gerente, subordinado))
+                carregar_hierarquia.clear() # Limpa cache de hierarquia
+                return True
+        except Exception:
+            return False
 
 @st.cache_data(ttl=600)
 def carregar_hierarquia():
-    conn = get_db_connection()
-    if conn is None: return pd.DataFrame()
-    try:
-        return pd.read_sql("SELECT gerente, subordinado FROM hierarquia ORDER BY gerente, subordinado;", conn)
-    except Exception:
-        return pd.DataFrame()
-    finally:
-        conn.close()
-
-@st.cache_data(ttl=600)
-def carregar_dados():
-    conn = get_db_connection()
-    if conn is None: return pd.DataFrame(), pd.DataFrame()
+    """Retorna (hierarquia_df, times); times = {gerente: (subordinados...)} dá lookup O(1) sem filtrar o DataFrame por rerun.
+    Gerentes e subordinados já vêm ordenados do banco (COLLATE "C" = ordem do sorted()), então a UI não reordena."""
+    with db_conn() as conn:
+        if conn is None:
+            # Falha sobe (não fica no cache): time vazio por 10 min esconderia os subordinados do gerente
+            if DB_PARAMS: raise psycopg2.OperationalError("Sem conexão com o banco para carregar a hierarquia.")
+            return pd.DataFrame(columns=['gerente', 'subordinado']), {}
+        # category: poucos nomes distintos repetidos em muitas linhas
+        hierarquia_df = pd.read_sql('SELECT gerente, subordinado FROM hierarquia ORDER BY gerente COLLATE "C", subordinado COLLATE "C";', conn).astype('category')
+        times = {g: tuple(subs) for g, subs in hierarquia_df.groupby('gerente', observed=True)['subordinado']}
+        return hierarquia_df, times
+
+# Tipos explícitos das colunas de atividades (evita colunas object para números e textos repetitivos)
+STATUS_DTYPE = pd.CategoricalDtype(['Pendente', 'Aprovado', 'Rejeitado']) # Categorias fixas: filtros por status comparam códigos int8
+ATIVIDADES_DTYPES = {'id': 'int32', 'mes': 'int32', 'ano': 'int32', 'mes_ano': 'int32', 'porcentagem': 'int32', 'usuario': 'category', 'descricao': 'category', 'projeto': 'category', 'status': STATUS_DTYPE}
+
+def ler_atividades_copy(conn, query):
+    """Lê atividades via COPY ... TO STDOUT: o CSV vai direto para o parser em C do pandas,
+    sem montar uma tupla Python por linha no psycopg2."""
+    buffer = io.BytesIO()
+    with conn.cursor() as cursor:
+        cursor.copy_expert(f"COPY ({query}) TO STDOUT WITH CSV HEADER", buffer)
+    buffer.seek(0)
+    # keep_default_na=False: observação vazia/nula continua string ('') como antes
+    return pd.read_csv(buffer, dtype={'observacao': str, **ATIVIDADES_DTYPES}, parse_dates=['data'], keep_default_na=False)
+
+@st.cache_resource(ttl=3600, show_spinner=False) # Muda pouco; toda escrita em usuarios já chama .clear()
+def carregar_usuarios():
+    """usuarios_df compartilhado pelo processo (somente leitura). Atividades são lidas sob demanda,
+    já filtradas no banco: carregar_atividades_usuario / carregar_atividades_time / carregar_atividades."""
+    with db_conn() as conn:
+        if conn is None:
+            # Banco configurado mas sem conexão (pool esgotado/fora do ar): exceção não fica no cache, vazio ficaria por 1 h
+            if DB_PARAMS: raise psycopg2.OperationalError("Sem conexão com o banco para carregar usuários.")
+            return pd.DataFrame(columns=['usuario', 'admin'])
+        return pd.read_sql('SELECT usuario, admin FROM usuarios ORDER BY usuario COLLATE "C";', conn) # Já na ordem dos selectbox
+
+@st.cache_resource(ttl=300, show_spinner=False) # TTL curto: cobre escritas de outras instâncias do app
+def carregar_atividades():
+    """Tabela completa de atividades (só o Consolidado do admin precisa dela). Somente leitura.
+    mes_ano = AAAAMM da data, calculado pelo banco uma vez por carga (filtro/agrupamento por mês sem strftime)."""
+    with db_conn() as conn:
+        if conn is None:
+            if DB_PARAMS: raise psycopg2.OperationalError("Sem conexão com o banco para carregar atividades.")
+            return pd.DataFrame()
+        # setup_db garante a coluna status NOT NULL: uma única consulta, sem retry nem COALESCE
+        return ler_atividades_copy(conn, "SELECT id, usuario, data, mes, ano, descricao, projeto, porcentagem, observacao, status, (EXTRACT(YEAR FROM data) * 100 + EXTRACT(MONTH FROM data))::int AS mes_ano FROM atividades ORDER BY ano DESC, mes DESC, data DESC")
+
+def carregar_ou_parar(carregar, *args):
+    """Chama um loader cacheado; se o banco falhar, mostra o erro e encerra o rerun (o próximo tenta de novo)."""
     try:
-        usuarios_df = pd.read_sql("SELECT usuario, admin FROM usuarios;", conn)
-        try:
-            atividades_df = pd.read_sql("SELECT id, usuario, data, mes, ano, descricao, projeto, porcentagem, observacao, status FROM atividades ORDER BY ano DESC, mes DESC, data DESC;", conn)
-        except Exception:
-             atividades_df = pd.read_sql("SELECT id, usuario, data, mes, ano, descricao, projeto, porcentagem, observacao FROM atividades ORDER BY ano DESC, mes DESC, data DESC;", conn)
-             atividades_df['status'] = 'Pendente'
+        return carregar(*args)
+    except (psycopg2.Error, pd.errors.DatabaseError) as e: # read_sql embrulha o erro do driver em DatabaseError
+        st.error(f"Erro ao carregar dados do banco: {e}")
+        st.stop()
 
-        if not atividades_df.empty:
-            atividades_df['data'] = pd.to_datetime(atividades_df['data'])
-        return usuarios_df, atividades_df
-    finally:
-        conn.close()
-
-def bulk_insert_usuarios(user_list):
-    conn = get_db_connection()
-    if conn is None: return 0, "Erro DB"
-    data_list = [(user, '123', False) for user in user_list]
-    try:
-        with conn.cursor() as cursor:
-            psycopg2.extras.execute_batch(cursor, "INSERT INTO usuarios (usuario, senha, admin) VALUES (%s, %s, %s) ON CONFLICT (usuario) DO NOTHING", data_list)
-            conn.commit()
-            carregar_dados.clear() # Limpa cache de usuários
-            return cursor.rowcount, "OK"
-    except Exception as e:
-        conn.rollback()
-        return 0, str(e)
-    finally:
-        conn.close()
+COPY_LIMIAR = 1000 # A partir de quantas linhas o COPY FROM STDIN compensa serializar o CSV
 
 def bulk_insert_atividades(df_to_insert):
-    conn = get_db_connection()
-    if conn is None: return 0, "Erro DB"
-    data_list = [tuple(row) for row in df_to_insert[['usuario', 'data', 'mes', 'ano', 'descricao', 'projeto', 'porcentagem', 'observacao', 'status']].values]
-    try:
-        with conn.cursor() as cursor:
-            psycopg2.extras.execute_batch(cursor, "INSERT INTO atividades (usuario, data, mes, ano, descricao, projeto, porcentagem, observacao, status) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)", data_list)
-            conn.commit()
+    from psycopg2.extras import execute_values
+    with db_conn() as conn:
+        if conn is None: return 0, "Erro DB"
+        colunas = ['usuario', 'data', 'mes', 'ano', 'descricao', 'projeto', 'porcentagem', 'observacao', 'status']
+        try:
+            with transacao(conn), conn.cursor() as cursor:
+                if len(df_to_insert) >= COPY_LIMIAR:
+                    # QUOTE_NONNUMERIC: texto vazio vai como "" (string vazia), só NaN vira NULL
+                    buffer = io.StringIO()
+                    df_to_insert[colunas].to_csv(buffer, header=False, index=False, quoting=csv.QUOTE_NONNUMERIC)
+                    buffer.seek(0)
+                    cursor.copy_expert(f"COPY atividades ({', '.join(colunas)}) FROM STDIN WITH CSV", buffer)
+                else:
+                    # Um INSERT multi-linha por página (500 linhas); as tuplas saem do itertuples sob demanda, sem lista intermediária
+                    execute_values(cursor, f"INSERT INTO atividades ({', '.join(colunas)}) VALUES %s",
+                                   df_to_insert[colunas].itertuples(index=False, name=None), page_size=BULK_PAGE_SIZE)
         
-        users_meses = df_to_insert[['usuario', 'mes', 'ano']].drop_duplicates()
-        for _, row in users_meses.iterrows():
-            ajustar_arredondamento_horas(row['usuario'], row['mes'], row['ano'])
+            users_meses = df_to_insert[['usuario', 'mes', 'ano']].drop_duplicates()
+            for _, row in users_meses.iterrows():
+                ajustar_arredondamento_horas(conn, row['usuario'], row['mes'], row['ano'])
             
-        carregar_dados.clear() # Garante cache limpo
-        return len(data_list), "OK"
-    except Exception as e:
-        conn.rollback()
-        return 0, str(e)
-    finally:
-        conn.close()
+            invalidar_atividades() # Garante cache limpo
+            return len(df_to_insert), "OK"
+        except Exception as e:
+            return 0, str(e)
 
 def limpar_nomes_usuarios_db():
-    conn = get_db_connection()
-    if conn is None: return False, "Erro DB"
-    try:
-        with conn.cursor() as cursor:
-            cursor.execute("UPDATE atividades SET usuario = TRIM(usuario);")
-            cursor.execute("UPDATE hierarquia SET gerente = TRIM(gerente), subordinado = TRIM(subordinado);")
-            cursor.execute("""
-                SELECT DISTINCT TRIM(usuario) FROM atividades UNION
-                SELECT DISTINCT TRIM(gerente) FROM hierarquia UNION
-                SELECT DISTINCT TRIM(subordinado) FROM hierarquia UNION
-                SELECT DISTINCT usuario FROM usuarios;
-            """)
-            usuarios_limpos = list(set([row[0] for row in cursor.fetchall()]))
-            cursor.execute("SELECT usuario, admin FROM usuarios;")
-            status_admin = dict(cursor.fetchall())
-            cursor.execute("TRUNCATE TABLE usuarios CASCADE;")
-            to_insert = [(u, '123', status_admin.get(u, False)) for u in usuarios_limpos]
-            if to_insert:
-                psycopg2.extras.execute_batch(cursor, "INSERT INTO usuarios (usuario, senha, admin) VALUES (%s, %s, %s)", to_insert)
-            conn.commit()
-            carregar_dados.clear() # Limpa caches após alteração massiva
-            carregar_hierarquia.clear() # Limpa caches após alteração massiva
-            return True, "Limpeza concluída."
-    except Exception as e:
-        conn.rollback()
-        return False, str(e)
-    finally:
-        conn.close()
+    """Apara espaços dos nomes em atividades/hierarquia e cria os usuários que faltarem, num único statement.
+    Usuários existentes (senha/admin) e os dados ficam intactos; só as linhas alteradas são reescritas."""
+    with db_conn() as conn:
+        if conn is None: return False, "Erro DB"
+        try:
+            with conn.cursor() as cursor:
+                # As FKs são verificadas ao fim do statement, depois do INSERT dos nomes aparados
+                cursor.execute("""
+                    WITH upd_atv AS (
+                        UPDATE atividades SET usuario = TRIM(usuario) WHERE usuario <> TRIM(usuario) RETURNING usuario
+                    ), upd_hier AS (
+                        UPDATE hierarquia SET gerente = TRIM(gerente), subordinado = TRIM(subordinado)
+                        WHERE gerente <> TRIM(gerente) OR subordinado <> TRIM(subordinado) RETURNING gerente, subordinado
+                    )
+                    INSERT INTO usuarios (usuario, senha, admin)
+                    SELECT usuario, %(senha)s, FALSE FROM upd_atv
+                    UNION SELECT gerente, %(senha)s, FALSE FROM upd_hier
+                    UNION SELECT subordinado, %(senha)s, FALSE FROM upd_hier
+                    ON CONFLICT (usuario) DO NOTHING;
+                """, {'senha': gerar_hash_senha(SENHA_PADRAO)})
+                invalidar_atividades() # Limpa caches após alteração massiva
+                carregar_usuarios.clear() # Usuários novos
+                carregar_hierarquia.clear() # Limpa caches após alteração massiva
+                return True, "Limpeza concluída."
+        except Exception as e:
+            return False, str(e)
 
 def carregar_atividades_usuario(usuario, mes, ano):
-    conn = get_db_connection()
-    if conn is None: return []
+    with db_conn() as conn:
+        if conn is None: return []
+        try:
+            with conn.cursor() as cursor:
+                executar_preparado(cursor, "sel_atividades_mes", """
+                    SELECT id, descricao, projeto, porcentagem, observacao, status FROM atividades
+                    WHERE usuario = $1 AND mes = $2 AND ano = $3 ORDER BY id DESC
+                """, (usuario, mes, ano))
+                colunas = [c.name for c in cursor.description]
+                return [dict(zip(colunas, linha)) for linha in cursor.fetchall()]
+        except Exception:
+            return []
+
+@st.cache_data(ttl=600, show_spinner=False)
+def carregar_atividades_time(time, mes, ano):
+    """Atividades do mês só dos subordinados do gerente (filtro no banco, não no pandas)."""
+    colunas = ['id', 'usuario', 'descricao', 'projeto', 'porcentagem', 'observacao', 'status']
+    with db_conn() as conn:
+        # Erro sobe em vez de virar "nenhuma atividade" guardada no cache por 10 min
+        if conn is None and DB_PARAMS: raise psycopg2.OperationalError("Sem conexão com o banco para carregar as atividades do time.")
+        if conn is None or not time: return pd.DataFrame(columns=colunas)
+        with conn.cursor() as cursor:
+            executar_preparado(cursor, "sel_atividades_time", """
+                SELECT id, usuario, descricao, projeto, porcentagem, observacao, status FROM atividades
+                WHERE usuario = ANY($1::varchar[]) AND mes = $2 AND ano = $3 ORDER BY usuario, id DESC
+            """, (list(time), mes, ano))
+            return pd.DataFrame(cursor.fetchall(), columns=colunas).astype({'usuario': 'category', 'status': STATUS_DTYPE})
+
+def carregar_totais_ativos(usuarios):
+    """Soma não rejeitada por (usuario, mes, ano), só para os usuários informados (validação de importação)."""
+    colunas = ['usuario', 'mes', 'ano', 'existente']
+    with db_conn() as conn:
+        if conn is None: return pd.DataFrame(columns=colunas)
+        with conn.cursor() as cursor:
+            executar_preparado(cursor, "sel_totais_ativos", """
+                SELECT usuario, mes, ano, SUM(porcentagem) FROM atividades
+                WHERE usuario = ANY($1::varchar[]) AND status != 'Rejeitado' GROUP BY usuario, mes, ano
+            """, (list(usuarios),))
+            # astype: resultado vazio também precisa de mes/ano inteiros para o merge com a planilha
+            return pd.DataFrame(cursor.fetchall(), columns=colunas).astype({'mes': 'int32', 'ano': 'int32', 'existente': 'int64'})
+
+def is_user_a_manager(usuario, times):
+    return usuario in times
+
+# --- IMPORTAÇÃO ---
+def ler_csv_importacao(arquivo):
+    """Detecta o delimitador uma vez (csv.Sniffer numa amostra) e lê com o parser em C do pandas,
+    em vez de sep=None, que obriga o engine='python' (bem mais lento) no arquivo inteiro."""
+    amostra = arquivo.read(8192).decode('utf-8', errors='ignore')
+    arquivo.seek(0)
+    amostra = amostra[:amostra.rfind('\n') + 1] or amostra # Só linhas completas
     try:
-        df = pd.read_sql("SELECT id, descricao, projeto, porcentagem, observacao, status FROM atividades WHERE usuario = %s AND mes = %s AND ano = %s ORDER BY id DESC;", conn, params=(usuario, mes, ano))
-        return df.to_dict('records')
-    except Exception:
-        return []
-    finally:
-        conn.close()
-
-def is_user_a_manager(usuario, hierarquia_df):
-    if hierarquia_df.empty: return False
-    return usuario in hierarquia_df['gerente'].unique()
-
-# --- CALLBACK DE DELETE ---
-def handle_delete(atividade_id):
-    if apagar_atividade(atividade_id):
-        # A função apagar_atividade agora limpa o cache e faz o ajuste.
-        st.toast("Atividade apagada e percentuais recalculados!", icon="🗑️")
-        st.rerun()
-    else:
-        st.toast("Erro ao apagar a atividade.", icon="❌")
+        sep = csv.Sniffer().sniff(amostra, delimiters=';,\t|').delimiter
+    except csv.Error:
+        sep = ','
+    return pd.read_csv(arquivo, sep=sep)
+
+def converter_datas_importacao(serie):
+    """DD/MM/AAAA com format= explícito (parser rápido, sem inferência); o que sobrar tenta ISO (AAAA-MM-DD)
+    e só então a conversão genérica dayfirst. cache=True converte cada data repetida uma única vez."""
+    if pd.api.types.is_datetime64_any_dtype(serie): return serie # Excel já entrega datas
+    texto = serie.astype(str).str.strip()
+    datas = pd.to_datetime(texto, format='%d/%m/%Y', errors='coerce', cache=True)
+    resto = datas.isna() & serie.notna()
+    if resto.any():
+        # Antes do dayfirst, que troca dia e mês em '2024-02-03' (viraria 02/03)
+        datas[resto] = pd.to_datetime(texto[resto], format='ISO8601', errors='coerce', cache=True)
+        resto = datas.isna() & serie.notna()
+    if resto.any():
+        datas[resto] = pd.to_datetime(texto[resto], errors='coerce', dayfirst=True, cache=True)
+    return datas
+
+# --- EXPORTAÇÃO (o .xlsx só é gerado quando alguém clica em baixar) ---
+MIME_XLSX = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+def excel_sob_demanda(df, sheet_name='Sheet1', colunas=None):
+    """Devolve um callable para st.download_button: o openpyxl roda no clique, não em todo rerun.
+    `colunas` = {coluna: cabeçalho} escolhe e renomeia na própria escrita, sem copiar o DataFrame."""
+    def gerar():
+        buffer = io.BytesIO()
+        if colunas is None: df.to_excel(buffer, index=False, sheet_name=sheet_name)
+        else: df.to_excel(buffer, index=False, sheet_name=sheet_name, columns=list(colunas), header=list(colunas.values()))
+        return buffer.getvalue()
+    return gerar
+
+# --- GRÁFICOS (memoizados pelos dados de entrada, não reconstruídos a cada rerun) ---
+PIZZA_MAX_FATIAS = 12
+
+@st.cache_data(show_spinner=False)
+def grafico_pizza_atividades(descricoes, porcentagens):
+    import plotly.express as px # Import tardio: sessões que não abrem gráfico não carregam o plotly
+    fatias = pd.Series(porcentagens, index=descricoes).groupby(level=0).sum().sort_values(ascending=False)
+    if len(fatias) > PIZZA_MAX_FATIAS: # Cauda vira uma fatia só: o pie do Plotly degrada com muitas fatias
+        fatias = pd.concat([fatias.iloc[:PIZZA_MAX_FATIAS], pd.Series({'Outros': fatias.iloc[PIZZA_MAX_FATIAS:].sum()})])
+    df_g = pd.DataFrame({'descricao': fatias.index, 'porcentagem': fatias.to_numpy()})
+    fig = px.pie(df_g, names='descricao', values='porcentagem', hole=0.5, color_discrete_sequence=SINAPSIS_PALETTE)
+    fig.update_layout(margin=dict(t=0, b=0, l=0, r=0), height=200)
+    return fig
+
+@st.cache_data(show_spinner=False)
+def grafico_total_mensal(meses, totais):
+    import plotly.express as px
+    return px.bar(pd.DataFrame({'m_a': meses, 'porcentagem': totais}), x='m_a', y='porcentagem', title="Total Alocado")
 
 # --- DADOS FIXOS ---
-DESCRICOES = ["1.001 - Gestão","1.002 - Geral","1.003 - Conselho","1.004 - Treinamento e Desenvolvimento", "2.001 - Gestão do administrativo","2.002 - Administrativa","2.003 - Jurídica","2.004 - Financeira", "2.006 - Fiscal","2.007 - Infraestrutura TI","2.008 - Treinamento interno","2.011 - Análise de dados", "2.012 - Logística de viagens","2.013 - Prestação de contas","2.014 - Compras e Suprimentos", "3.001 - Prospecção de oportunidades", "3.002 - Prospecção de temas","3.003 - Administração comercial","3.004 - Marketing Digital", "3.005 - Materiais de apoio","3.006 - Grupos de Estudo","3.007 - Elaboração de POC/Piloto", "3.008 - Elaboração e apresentação de proposta","3.009 - Acompanhamento de proposta", "3.010 - Reunião de acompanhamento de funil","3.011 - Planejamento Estratégico/Comercial", "3.012 - Sucesso do Cliente","3.013 - Participação em eventos","4.001 - Planejamento de projeto", "4.002 - Gestão de projeto","4.003 - Reuniões internas de trabalho","4.004 - Reuniões externas de trabalho", "4.005 - Pesquisa","4.006 - Especificação de software","4.007 - Desenvolvimento de software/rotinas", "4.008 - Coleta e preparação de dados","4.009 - Elaboração de estudos e modelos","4.010 - Confecção de relatórios técnicos", "4.011 - Confecção de apresentações técnicas","4.012 - Confecção de artigos técnicos","4.013 - Difusão de resultados", "4.014 - Elaboração de documentação final","4.015 - Finalização do projeto","5.001 - Gestão de desenvolvimento", "5.002 - Planejamento de projeto","5.003 - Gestão de projeto","5.004 - Reuniões internas de trabalho", "5.005 - Reuniões externa de trabalho","5.006 - Pesquisa","5.007 - Coleta e preparação de dados", "5.008 - Modelagem","5.009 - Análise de tarefa","5.010 - Especificação de tarefa","5.011 - Correção de bug", "5.012 - Desenvolvimento de melhorias","5.013 - Desenvolvimento de novas funcionalidades", "5.014 - Desenvolvimento de integrações","5.015 - Treinamento interno","5.016 - Documentação", "5.017 - Atividades gerenciais","5.018 - Estudos","6.001 - Gestão de equipe","6.002 - Pesquisa", "6.003 - Especificação de testes","6.004 - Desenvolvimento de automações","6.005 - Realização de testes", "6.006 - Reuniões internas de trabalho","6.007 - Treinamento interno","6.008 - Elaboração de material", "7.001 - Gestão de equipe","7.002 - Pesquisa e estudos","7.003 - Análise de ticket","7.004 - Reuniões internas de trabalho", "7.005 - Reuniões externas de trabalho","7.006 - Preparação de treinamento externo","7.007 - Realização de treinamento externo", "7.008 - Documentação de treinamento","7.009 - Treinamento interno","7.010 - Criação de tarefa","7.011 - Acompanhamento dos Chamados em Desenvolvimento","9.001 - Gestão do RH", "9.002 - Recrutamento e seleção","9.003 - Participação em eventos","9.004 - Pesquisa e estratégia","9.005 -Treinamento e desenvolvimento", "9.006 - Registro de feedback","9.007 - Avaliação de RH","9.008 - Elaboração de conteúdo","9.009 - Comunicação interna", "9.010 - Reuniões internas de trabalho","9.011 - Reunião externa","9.012 - Apoio contábil e financeiro","10.001 - Planejamento de operação", "10.002 - Gestão de operação","10.003 - Reuniões internas de trabalho","10.004 - Reuniões externas de trabalho", "10.005 - Especificação de melhoria ou correção de software","10.006 - Desenvolvimento de automações", "10.007 - Coleta e preparação de dados","10.008 - Elaboração de estudos e modelos","10.009 - Confecção de relatórios técnicos", "10.010 - Confecção de apresentações técnicas","10.011 - Confecção de artigos técnicos","10.012 - Difusão de resultados", "10.013 - Preparação de treinamento externo","10.014 - Realização de treinamento externo","10.015 - Mapeamento de Integrações"]
-PROJETOS = [
+DESCRICOES = ("1.001 - Gestão","1.002 - Geral","1.003 - Conselho","1.004 - Treinamento e Desenvolvimento", "2.001 - Gestão do administrativo","2.002 - Administrativa","2.003 - Jurídica","2.004 - Financeira", "2.006 - Fiscal","2.007 - Infraestrutura TI","2.008 - Treinamento interno","2.011 - Análise de dados", "2.012 - Logística de viagens","2.013 - Prestação de contas","2.014 - Compras e Suprimentos", "3.001 - Prospecção de oportunidades", "3.002 - Prospecção de temas","3.003 - Administração comercial","3.004 - Marketing Digital", "3.005 - Materiais de apoio","3.006 - Grupos de Estudo","3.007 - Elaboração de POC/Piloto", "3.008 - Elaboração e apresentação de proposta","3.009 - Acompanhamento de proposta", "3.010 - Reunião de acompanhamento de funil","3.011 - Planejamento Estratégico/Comercial", "3.012 - Sucesso do Cliente","3.013 - Participação em eventos","4.001 - Planejamento de projeto", "4.002 - Gestão de projeto","4.003 - Reuniões internas de trabalho","4.004 - Reuniões externas de trabalho", "4.005 - Pesquisa","4.006 - Especificação de software","4.007 - Desenvolvimento de software/rotinas", "4.008 - Coleta e preparação de dados","4.009 - Elaboração de estudos e modelos","4.010 - Confecção de relatórios técnicos", "4.011 - Confecção de apresentações técnicas","4.012 - Confecção de artigos técnicos","4.013 - Difusão de resultados", "4.014 - Elaboração de documentação final","4.015 - Finalização do projeto","5.001 - Gestão de desenvolvimento", "5.002 - Planejamento de projeto","5.003 - Gestão de projeto","5.004 - Reuniões internas de trabalho", "5.005 - Reuniões externa de trabalho","5.006 - Pesquisa","5.007 - Coleta e preparação de dados", "5.008 - Modelagem","5.009 - Análise de tarefa","5.010 - Especificação de tarefa","5.011 - Correção de bug", "5.012 - Desenvolvimento de melhorias","5.013 - Desenvolvimento de novas funcionalidades", "5.014 - Desenvolvimento de integrações","5.015 - Treinamento interno","5.016 - Documentação", "5.017 - Atividades gerenciais","5.018 - Estudos","6.001 - Gestão de equipe","6.002 - Pesquisa", "6.003 - Especificação de testes","6.004 - Desenvolvimento de automações","6.005 - Realização de testes", "6.006 - Reuniões internas de trabalho","6.007 - Treinamento interno","6.008 - Elaboração de material", "7.001 - Gestão de equipe","7.002 - Pesquisa e estudos","7.003 - Análise de ticket","7.004 - Reuniões internas de trabalho", "7.005 - Reuniões externas de trabalho","7.006 - Preparação de treinamento externo","7.007 - Realização de treinamento externo", "7.008 - Documentação de treinamento","7.009 - Treinamento interno","7.010 - Criação de tarefa","7.011 - Acompanhamento dos Chamados em Desenvolvimento","9.001 - Gestão do RH", "9.002 - Recrutamento e seleção","9.003 - Participação em eventos","9.004 - Pesquisa e estratégia","9.005 -Treinamento e desenvolvimento", "9.006 - Registro de feedback","9.007 - Avaliação de RH","9.008 - Elaboração de conteúdo","9.009 - Comunicação interna", "9.010 - Reuniões internas de trabalho","9.011 - Reunião externa","9.012 - Apoio contábil e financeiro","10.001 - Planejamento de operação", "10.002 - Gestão de operação","10.003 - Reuniões internas de trabalho","10.004 - Reuniões externas de trabalho", "10.005 - Especificação de melhoria ou correção de software","10.006 - Desenvolvimento de automações", "10.007 - Coleta e preparação de dados","10.008 - Elaboração de estudos e modelos","10.009 - Confecção de relatórios técnicos", "10.010 - Confecção de apresentações técnicas","10.011 - Confecção de artigos técnicos","10.012 - Difusão de resultados", "10.013 - Preparação de treinamento externo","10.014 - Realização de treinamento externo","10.015 - Mapeamento de Integrações")
+PROJETOS = (
     # NOVOS PROJETOS INSERIDOS
     "(Interno) Diretoria Operacional",
     "657-0 (CPTM) USTDA Consultoria",
@@ -550,13 +743,29 @@ PROJETOS = [
     "662-0 (EDP Renováveis) Estudo para conexão de UFVs",
     # PROJETOS EXISTENTES
     "101-0 (Interno) Diretoria Executiva","102-0 (Interno) Diretoria Administrativa","103-0 (Interno) Diretoria de Engenharia", "104-0 (Interno) Diretoria de Negócios","105-0 (Interno) Diretoria de Produtos","106-0 (Interno) Diretoria de Tecnologia", "107-0 (Interno) Departamento Administrativo","108-0 (Interno) Departamento de Gente e Cultura","109-0 (Interno) Departamento de Infraestrutura", "110-0 (Interno) Departamento de Marketing","111-0 (Interno) Departamento de Operação","112-0 (Interno) Departamento de Sucesso do Cliente", "113-0 (Interno) Produto ARIES","114-0 (Interno) Produto ActionWise","115-0 (Interno) Produto Carga Base","116-0 (Interno) Produto Godel Perdas", "117-0 (Interno) Produto Godel Conecta","118-0 (Interno) Produto SIGPerdas","119-0 (Interno) Produto SINAPgrid","120-0 (Interno) Produto SINAP4.0", "121-0 (Interno) SINAPgrid Acadêmico","122-0 (Interno) Produto SINAPgateway (BAGRE)","123-0 (Interno) Produto SINAPautomação e diagnóstico (autobatch)", "302-0 (SENSE - Equatorial) Virtus","402-0 (SOFTEX - Copel) Renovação de Ativos Continuação","573-0 (ENEL SP, RJ e CE) Suporte e Manutenção do Software SINAP T&D","573-1 (ENEL) Suporte SINAPgrid", "573-2 (ENEL) Re-configuração","575-0 (Amazonas) Suporte SINAPgrid","578-1 (Copel) Suporte SINAPgrid","578-2 (Copel) Suporte Godel Conecta", "578-3 (Copel) Suporte GDIS","581-0 (CERILUZ) Suporte SINAPgrid","583-0 (CERTAJA) Suporte SINAPgrid","584-0 (CERTEL) Suporte SINAPgrid", "585-0 (COOPERLUZ) Suporte SINAPgrid","587-0 (COPREL) Suporte SINAPgrid","606-0 (Roraima) Suporte SINAPgrid","615-0 (Energisa) Suporte SIGPerdas","620-0 (CPFL) Plataforma Planejamento Sistema Elétrico","620-1 (CPFL) Suporte SINAPgrid","636-0 (Equatorial Energia GO) Cálculo de Perdas GeoPerdas",
-"638-1 (Amazonas) Suporte SIGPerdas","638-2 (Roraima) Suporte SIGPerdas","640-0 (SENAI - CTG) Hidrogênio Verde", "647-0 (Energisa) Consultoria de Estudos Elétricos","648-0 (Neoenergia) Suporte SINAPgrid","649-0 (Neoenergia) Godel PCom e Godel Analytics", "653-0 (Roraima) Projeto Gestor GDIS","655-0 (CELESC) Sistema Integrável de Matchmaking","658-0 (Copel) Planauto Continuação", "659-0 (Copel) Cálculo de Benefícios de Investimentos","660-0 (CERFOX) Suporte SINAPgrid","661-0 (ENEL SP, RJ e CE) Consultoria técnica BDGD", "663-0 (Banco Mundial) Eletromobilidade em São Paulo","666-0 (Energisa) Análise MM GD","667-0 (Energisa) Planejamento Decenal MT", "668-0 (Energisa) Critérios de Planejamento de SEs","669-0 (Desenvolve SP) Hub de Dados","670-0 (CPFL) Proteção","671-0 (Equatorial) Godel Perdas", "672-0 (ENEL SP) URD Subterrâneo","673-0 (Equatorial) PDD","674-0 (Energisa PB) Planejamento Decenal 2025","675-0 (EDEMSA) Godel Perdas Suporte Técnico Bromteck", "676-0 (Equatorial) PoC Resiliência","677-0 (Neoenergia) Suporte Godel Perdas","678-0 (CPFL) AMBAR","679-0 (ENEL) Godel Conecta", "680-0 (CESI) Angola Banco Mundial","681-0 (CEMACON) Suporte SINAPgrid","682-0 (FECOERGS) Treinamento SINAPgrid"]
+"638-1 (Amazonas) Suporte SIGPerdas","638-2 (Roraima) Suporte SIGPerdas","640-0 (SENAI - CTG) Hidrogênio Verde", "647-0 (Energisa) Consultoria de Estudos Elétricos","648-0 (Neoenergia) Suporte SINAPgrid","649-0 (Neoenergia) Godel PCom e Godel Analytics", "653-0 (Roraima) Projeto Gestor GDIS","655-0 (CELESC) Sistema Integrável de Matchmaking","658-0 (Copel) Planauto Continuação", "659-0 (Copel) Cálculo de Benefícios de Investimentos","660-0 (CERFOX) Suporte SINAPgrid","661-0 (ENEL SP, RJ e CE) Consultoria técnica BDGD", "663-0 (Banco Mundial) Eletromobilidade em São Paulo","666-0 (Energisa) Análise MM GD","667-0 (Energisa) Planejamento Decenal MT", "668-0 (Energisa) Critérios de Planejamento de SEs","669-0 (Desenvolve SP) Hub de Dados","670-0 (CPFL) Proteção","671-0 (Equatorial) Godel Perdas", "672-0 (ENEL SP) URD Subterrâneo","673-0 (Equatorial) PDD","674-0 (Energisa PB) Planejamento Decenal 2025","675-0 (EDEMSA) Godel Perdas Suporte Técnico Bromteck", "676-0 (Equatorial) PoC Resiliência","677-0 (Neoenergia) Suporte Godel Perdas","678-0 (CPFL) AMBAR","679-0 (ENEL) Godel Conecta", "680-0 (CESI) Angola Banco Mundial","681-0 (CEMACON) Suporte SINAPgrid","682-0 (FECOERGS) Treinamento SINAPgrid")
+# Conjuntos para validação O(1) de valores vindos de importação/edição
+DESCRICOES_SET = frozenset(DESCRICOES)
+PROJETOS_SET = frozenset(PROJETOS)
 
-DESCRICOES_SELECT = ["--- Selecione ---"] + DESCRICOES
-PROJETOS_SELECT = ["--- Selecione ---"] + PROJETOS
 MESES = {1: "01 - Janeiro", 2: "02 - Fevereiro", 3: "03 - Março", 4: "04 - Abril", 5: "05 - Maio", 6: "06 - Junho", 7: "07 - Julho", 8: "08 - Agosto", 9: "09 - Setembro", 10: "10 - Outubro", 11: "11 - Novembro", 12: "12 - Dezembro"}
-MESES_SELECT = ["--- Selecione ---"] + list(MESES.values())
-ANOS = list(range(datetime.today().year - 2, datetime.today().year + 3))
+MESES_INV = {v: k for k, v in MESES.items()} # Rótulo -> número do mês
+APROVACAO_POR_PAGINA = 20 # Linhas por página na tabela de aprovação (payload do data_editor limitado)
+CONSOLIDADO_MAX_LINHAS = 1000 # Linhas enviadas ao navegador no Consolidado; a exportação continua completa
+
+@st.cache_resource(show_spinner=False)
+def montar_constantes(ano_atual):
+    """Monta as listas de opções (tuplas imutáveis) uma vez por processo e por ano."""
+    return (
+        ("--- Selecione ---", *DESCRICOES),
+        ("--- Selecione ---", *PROJETOS),
+        tuple(range(ano_atual - 2, ano_atual + 3)),
+        tuple(MESES.values()),
+        ("--- Selecione ---", *MESES.values()),
+    )
+
+DESCRICOES_SELECT, PROJETOS_SELECT, ANOS, MESES_VALORES, MESES_SELECT = montar_constantes(datetime.today().year)
+ANO_ATUAL_IDX = 2 # ANOS vai de ano_atual-2 a ano_atual+2: o ano corrente é sempre o 3º item
 
 
 # --- INFORMAÇÕES FIXAS DA FAMÍLIA (DEPARTAMENTOS) ---
@@ -583,6 +792,119 @@ def format_department_guide(department_list):
     return f"<ul style='list-style-type: none; padding-left: 0; margin: 0;'>{items_html}</ul>"
 
 
+# ==============================
+# 5. Componentes de Interface
+# ==============================
+@st.fragment
+def minhas_atividades(usuario, hoje):
+    """Aba Minhas Atividades: trocar mês/ano ou editar a tabela reexecuta só este trecho, não a página inteira."""
+    st.header("📋 Minhas Atividades")
+    c1, c2 = st.columns(2)
+    mes_sel = c1.selectbox("Mês", MESES_SELECT, index=hoje.month, key="m_a")
+    ano_sel = c2.selectbox("Ano", ANOS, index=ANO_ATUAL_IDX, key="a_a")
+    mes_num = MESES_INV.get(mes_sel)
+    
+    if not mes_num: st.stop()
+    
+    atividades = carregar_atividades_usuario(usuario, mes_num, ano_sel)
+    ativas = [a for a in atividades if a['status'] != 'Rejeitado']
+    total = sum(a['porcentagem'] for a in ativas)
+    
+    col_met, col_graph = st.columns([1, 2])
+    col_met.metric("Total Alocado", f"{total}%", f"{100-total}% restante")
+    
+    if ativas:
+        fig = grafico_pizza_atividades(tuple(a['descricao'] for a in ativas), tuple(a['porcentagem'] for a in ativas))
+        col_graph.plotly_chart(fig, use_container_width=True)
+
+    st.markdown("---")
+    
+    c_copy, c_exp = st.columns(2)
+    if c_copy.button("Copiar Mês Anterior", use_container_width=True):
+        m_ant = mes_num - 1 if mes_num > 1 else 12
+        a_ant = ano_sel if mes_num > 1 else ano_sel - 1
+        antigos = carregar_atividades_usuario(usuario, m_ant, a_ant)
+        if antigos:
+            # Um INSERT para o mês inteiro; já limpa o cache.
+            salvar_atividades_em_massa(usuario, mes_num, ano_sel, [(a['descricao'], a['projeto'], a['porcentagem'], a['observacao']) for a in antigos])
+            st.rerun()
+    
+    if ativas:
+        df_ex = pd.DataFrame(ativas)
+        df_ex['observacao'] = limpar_observacoes(df_ex['observacao'])
+        c_exp.download_button("Exportar Excel", excel_sob_demanda(df_ex), "atividades.xlsx", mime=MIME_XLSX, on_click="ignore", use_container_width=True)
+
+    if atividades:
+        st.subheader("Edição")
+        st.caption("Somente atividades pendentes podem ser alteradas; em lançamentos por horas o % é recalculado automaticamente.")
+        df_orig = pd.DataFrame(atividades)
+        df_orig['observacao'] = limpar_observacoes(df_orig['observacao'])
+        df_orig.insert(0, 'Apagar', False)
+        chave_editor = f"edit_atv_{mes_num}_{ano_sel}"
+        edited = st.data_editor(
+            df_orig,
+            key=chave_editor,
+            hide_index=True,
+            use_container_width=True,
+            disabled=['id', 'status'],
+            column_order=['Apagar', 'id', 'descricao', 'projeto', 'porcentagem', 'observacao', 'status'],
+            column_config={
+                "Apagar": st.column_config.CheckboxColumn("🗑️", default=False),
+                "id": st.column_config.NumberColumn("ID", width="small"),
+                "descricao": st.column_config.SelectboxColumn("Descrição", options=DESCRICOES, required=True),
+                "projeto": st.column_config.SelectboxColumn("Projeto", options=PROJETOS, required=True),
+                "porcentagem": st.column_config.NumberColumn("%", min_value=0, max_value=100, step=1, required=True),
+                "observacao": st.column_config.TextColumn("Obs"),
+                "status": st.column_config.TextColumn("Status"),
+            }
+        )
+
+        if st.button("💾 Salvar alterações", type="primary", use_container_width=True):
+            horas = {a['id']: extrair_hora_bruta(a.get('observacao', ''))[0] for a in atividades}
+            ids_del = edited.loc[edited['Apagar'], 'id'].tolist()
+
+            # Diff vetorizado contra o original: só linhas pendentes, não apagadas e com algum campo alterado
+            campos = ['descricao', 'projeto', 'porcentagem', 'observacao']
+            comp = edited.merge(df_orig[['id'] + campos], on='id', suffixes=('', '_old'))
+            comp['porcentagem'] = comp['porcentagem'].fillna(comp['porcentagem_old']).astype(int)
+            comp['observacao'] = comp['observacao'].fillna('')
+            modificada = pd.concat([comp[c] != comp[f"{c}_old"] for c in campos], axis=1).any(axis=1)
+            # O editor não trava célula por linha: edição em linha bloqueada é recusada, não descartada em silêncio
+            pendente = comp['status'] == 'Pendente'
+            bloqueadas = comp.loc[modificada & ~pendente & ~comp['Apagar'], 'id'].tolist()
+            if bloqueadas:
+                st.toast(f"Erro: somente atividades pendentes podem ser alteradas (ID {', '.join(map(str, bloqueadas))}).", icon="❌")
+                st.stop()
+            por_horas = comp.loc[(comp['id'].map(horas) > 0) & (comp['porcentagem'] != comp['porcentagem_old']) & ~comp['Apagar'], 'id'].tolist()
+            if por_horas:
+                st.toast(f"Erro: em lançamentos por horas o % é recalculado automaticamente (ID {', '.join(map(str, por_horas))}).", icon="❌")
+                st.stop()
+            alteradas = comp[modificada & pendente & ~comp['Apagar']]
+            # Só valida o campo que mudou: linha antiga com descrição/projeto fora do catálogo ainda salva % e Obs
+            invalida = ((alteradas['descricao'] != alteradas['descricao_old']) & ~alteradas['descricao'].isin(DESCRICOES_SET)) | \
+                       ((alteradas['projeto'] != alteradas['projeto_old']) & ~alteradas['projeto'].isin(PROJETOS_SET))
+            if invalida.any():
+                st.toast(f"Erro: descrição ou projeto inválido (ID {', '.join(map(str, alteradas.loc[invalida, 'id']))}).", icon="❌")
+                st.stop()
+
+            restantes = comp[~comp['Apagar'] & (comp['status'] != 'Rejeitado')]
+            if restantes['porcentagem'].sum() > 100:
+                st.toast("Erro: > 100%", icon="❌")
+                st.stop()
+
+            alteracoes = [
+                (int(r.id), r.descricao, r.projeto, int(r.porcentagem), f"[HORA:{horas[r.id]}|{r.observacao}]" if horas[r.id] > 0 else r.observacao)
+                for r in alteradas.itertuples(index=False)
+            ]
+            if not alteracoes and not ids_del:
+                st.toast("Nenhuma alteração para salvar.", icon="ℹ️")
+            elif aplicar_edicoes_atividades(alteracoes, ids_del):
+                st.session_state.pop(chave_editor, None)
+                st.toast("Atividades atualizadas e percentuais recalculados!", icon="✅")
+                st.rerun()
+            else:
+                st.toast("Erro ao salvar!", icon="❌")
+
 # ==============================
 # 6. Sessão e Login
 # ==============================
@@ -592,30 +914,23 @@ if "usuario" not in st.session_state:
 if 'show_change_password' not in st.session_state:
     st.session_state['show_change_password'] = False
 
-usuarios_df, atividades_df = carregar_dados()
-hierarquia_df = carregar_hierarquia()
-
-st.markdown(
-    f"""
-    <style>
-        :root {{ --primary-color: #19c0d1; --secondary-background-color: {COR_FUNDO_SIDEBAR}; }}
-        [data-testid="stSidebar"] {{ background-color: {COR_FUNDO_SIDEBAR}; }}
-        [data-testid="stSidebar"] * {{ color: #FFFFFF !important; }}
-        [data-testid="stSidebar"] .stButton > button {{ background-color: {COR_FUNDO_SIDEBAR} !important; border: 1px solid #FFFFFF30; color: #FFFFFF !important; }}
-        [data-testid="stSidebar"] .stButton > button:hover {{ background-color: {COR_SECUNDARIA} !important; }}
-        [data-testid="stSidebar"] .stRadio > label[data-testid*="stRadioInline"]:has(input:checked) {{ background-color: {COR_SECUNDARIA} !important; border-radius: 5px; }}
-        .stApp {{ background-color: {COR_FUNDO_APP}; }}
-        .modebar {{ display: none !important; }}
-        .status-badge {{ padding: 4px 8px; border-radius: 12px; font-size: 0.9em; font-weight: bold; display: inline-block; }}
-        .status-Pendente {{ background-color: #ffcc99; color: #cc6600; }}
-        .status-Aprovado {{ background-color: #ccffcc; color: #008000; }}
-        .status-Rejeitado {{ background-color: #ff9999; color: #cc0000; }}
-        /* Garante que o texto dentro dos itens da lista de Guia não mude de cor */
-        .stMarkdown ul li {{ color: {COR_CINZA} !important; }} 
-        [data-testid="stSidebar"] img {{ filter: brightness(1.5) contrast(1.5); }}
-    </style>
-    """, unsafe_allow_html=True
-)
+# Callbacks rodam antes do rerun do clique: sem st.rerun() extra
+def alternar_troca_senha():
+    st.session_state['show_change_password'] = not st.session_state['show_change_password']
+
+def sair():
+    st.session_state["usuario"] = None
+
+def aplicar_status_aprovacao(ids, novo_status):
+    """Aprovar/Rejeitar: grava e zera a seleção de todas as páginas (seleção é por posição e as linhas mudam)."""
+    if atualizar_status_em_massa(ids, novo_status):
+        for chave in [k for k in st.session_state if str(k).startswith("editor_aprovacao_")]:
+            del st.session_state[chave]
+
+usuarios_df = carregar_ou_parar(carregar_usuarios)
+hierarquia_df, times = carregar_ou_parar(carregar_hierarquia)
+
+st.markdown(carregar_css(), unsafe_allow_html=True)
 
 if LOGO_URL: st.sidebar.image(LOGO_URL, use_container_width=True)
 st.sidebar.markdown("<br>", unsafe_allow_html=True)
@@ -636,9 +951,7 @@ if st.session_state["usuario"] is None:
                 st.error("Credenciais inválidas")
 else:
     st.sidebar.markdown(f"**Usuário:** {st.session_state['usuario']}")
-    if st.sidebar.button("🔑 Alterar Senha"):
-        st.session_state['show_change_password'] = not st.session_state['show_change_password']
-        st.rerun()
+    st.sidebar.button("🔑 Alterar Senha", on_click=alternar_troca_senha)
     
     if st.session_state['show_change_password']:
         with st.sidebar.form("form_senha"):
@@ -654,17 +967,16 @@ else:
                     st.sidebar.error("Senhas divergem.")
     
     st.sidebar.markdown("---")
-    if st.sidebar.button("Sair"):
-        st.session_state["usuario"] = None
-        st.rerun()
+    st.sidebar.button("Sair", on_click=sair)
 
-    is_manager = is_user_a_manager(st.session_state["usuario"], hierarquia_df)
+    is_manager = is_user_a_manager(st.session_state["usuario"], times)
     
     abas = ["Lançar Atividade", "Minhas Atividades", "Importar Dados"]
     if st.session_state["admin"] or is_manager: abas.append("Gerenciar Time")
     if st.session_state["admin"]: abas += ["Gerenciar Usuários", "Consolidado"]
     
     aba = st.sidebar.radio("Menu", abas)
+    hoje = datetime.now() # Uma única leitura do relógio por rerun
 
     # ==============================
     # ABA: Gerenciar Usuários (Admin)
@@ -675,7 +987,7 @@ else:
              ok, msg = limpar_nomes_usuarios_db()
              if ok: st.success(msg)
              else: st.error(msg)
-             # As funções de limpeza agora chamam carregar_dados.clear()
+             # As funções de limpeza agora chamam invalidar_atividades()
              st.rerun()
         
         with st.form("add_user"):
@@ -697,16 +1009,15 @@ else:
     # ==============================
     elif aba == "Gerenciar Time":
         st.header("🤝 Gerenciar Equipe")
-        hierarquia_df = carregar_hierarquia()
-        usuarios_list = usuarios_df['usuario'].tolist()
-        
+        # A aba só aparece no menu para admin ou gerente; a lista de usuários só é montada para o admin
         if st.session_state["admin"]:
+            usuarios_list = usuarios_df['usuario'].tolist()
             st.subheader("Configurar Hierarquia (Admin)")
             with st.form("hierarquia"):
                 c1, c2 = st.columns(2)
                 # Termos ajustados
-                g = c1.selectbox("Gerente da Área", sorted(usuarios_list))
-                s = c2.selectbox("Pessoa da Área", ["---"] + sorted([u for u in usuarios_list if u != g]))
+                g = c1.selectbox("Gerente da Área", usuarios_list)
+                s = c2.selectbox("Pessoa da Área", ["---"] + [u for u in usuarios_list if u != g])
                 if st.form_submit_button("Associar"):
                     if s != "---":
                         if salvar_hierarquia(g, s):
@@ -723,9 +1034,9 @@ else:
                 
                 with st.form("del_hierarquia"):
                      # Termos ajustados
-                     g_rem = st.selectbox("Gerente da Área (Remover)", sorted(hierarquia_df['gerente'].unique()))
-                     subs = hierarquia_df[hierarquia_df['gerente'] == g_rem]['subordinado'].tolist()
-                     s_rem = st.selectbox("Pessoa da Área (Remover)", sorted(subs)) if subs else None
+                     g_rem = st.selectbox("Gerente da Área (Remover)", list(times))
+                     subs = times.get(g_rem, ())
+                     s_rem = st.selectbox("Pessoa da Área (Remover)", subs) if subs else None
                      if st.form_submit_button("Remover"):
                          if apagar_hierarquia(g_rem, s_rem):
                              # apagar_hierarquia agora limpa o cache.
@@ -736,36 +1047,28 @@ else:
         # Análise e Aprovação
         st.markdown("---")
         st.subheader("Aprovação")
-        gerentes_validos = hierarquia_df['gerente'].unique()
-        
         if st.session_state["admin"]:
             # Termos ajustados
-            gerente_analise = st.selectbox("Selecione o Gerente da Área", sorted(gerentes_validos))
-        elif st.session_state["usuario"] in gerentes_validos:
+            gerente_analise = st.selectbox("Selecione o Gerente da Área", list(times))
+        elif st.session_state["usuario"] in times:
             gerente_analise = st.session_state["usuario"]
         else:
             # Termos ajustados
             st.warning("Você não é Gerente da Área.")
             st.stop()
             
-        time = hierarquia_df[hierarquia_df['gerente'] == gerente_analise]['subordinado'].tolist()
+        time = times.get(gerente_analise, ())
         
         c_mes, c_ano = st.columns(2)
-        mes_analise = c_mes.selectbox("Mês", list(MESES.values()), index=datetime.now().month-1)
-        ano_analise = c_ano.selectbox("Ano", ANOS, index=ANOS.index(datetime.now().year))
-        mes_num = next(k for k,v in MESES.items() if v == mes_analise)
+        mes_analise = c_mes.selectbox("Mês", MESES_VALORES, index=hoje.month-1)
+        ano_analise = c_ano.selectbox("Ano", ANOS, index=ANO_ATUAL_IDX)
+        mes_num = MESES_INV[mes_analise]
         
-        df_time = atividades_df[
-            (atividades_df['usuario'].isin(time)) & 
-            (atividades_df['mes'] == mes_num) & 
-            (atividades_df['ano'] == ano_analise)
-        ]
+        df_time = carregar_ou_parar(carregar_atividades_time, time, mes_num, ano_analise)
         
-        # Resumo Alocação
-        resumo = df_time.groupby('usuario')['porcentagem'].sum().reset_index()
-        for u in time:
-            if u not in resumo['usuario'].values:
-                resumo.loc[len(resumo)] = [u, 0]
+        # Resumo Alocação (df_time já é só o mês do time; quem não lançou nada aparece com 0)
+        totais = df_time.groupby('usuario', observed=True)['porcentagem'].sum().reindex(time, fill_value=0)
+        resumo = pd.DataFrame({'usuario': time, 'porcentagem': totais.astype(int).to_numpy()})
         
         st.dataframe(
             resumo.sort_values('porcentagem', ascending=False), 
@@ -779,7 +1082,7 @@ else:
         c_f1, c_f2 = st.columns(2)
         status_f = c_f1.selectbox("Status", ["Todos", "Pendente", "Aprovado", "Rejeitado"])
         # Termos ajustados
-        user_f = c_f2.selectbox("Pessoa da Área", ["Todos"] + sorted(time))
+        user_f = c_f2.selectbox("Pessoa da Área", ["Todos", *time])
         
         df_view = df_time.copy()
         if status_f != "Todos": df_view = df_view[df_view['status'] == status_f]
@@ -788,12 +1091,15 @@ else:
         if df_view.empty:
             st.info("Sem dados.")
         else:
-            df_view['Selecionar'] = False
-            df_view['observacao_limpa'] = df_view['observacao'].apply(lambda x: extrair_hora_bruta(x)[1])
+            paginas = -(-len(df_view) // APROVACAO_POR_PAGINA)
+            pagina = st.number_input("Página", 1, paginas, 1) if paginas > 1 else 1
+            df_view = df_view.iloc[(pagina - 1) * APROVACAO_POR_PAGINA : pagina * APROVACAO_POR_PAGINA].assign(
+                Selecionar=False, observacao_limpa=lambda d: limpar_observacoes(d['observacao']))
+            if paginas > 1: st.caption("Aprovar/Rejeitar valem para as linhas selecionadas nesta página.")
             
             edited_df = st.data_editor(
                 df_view,
-                key="editor_aprovacao",
+                key=f"editor_aprovacao_{pagina}", # Seleção é por posição: cada página tem seu estado
                 hide_index=True,
                 use_container_width=True,
                 column_config={
@@ -810,14 +1116,11 @@ else:
             
             ids_sel = edited_df[edited_df['Selecionar']]['id'].tolist()
             c_btn1, c_btn2 = st.columns(2)
-            if c_btn1.button(f"Aprovar ({len(ids_sel)})", type="primary", disabled=not ids_sel, use_container_width=True):
-                if atualizar_status_em_massa(ids_sel, "Aprovado"):
-                    # atualizar_status_em_massa agora limpa o cache.
-                    st.rerun()
-            if c_btn2.button(f"Rejeitar ({len(ids_sel)})", type="secondary", disabled=not ids_sel, use_container_width=True):
-                if atualizar_status_em_massa(ids_sel, "Rejeitado"):
-                    # atualizar_status_em_massa agora limpa o cache.
-                    st.rerun()
+            # atualizar_status_em_massa limpa o cache; o callback roda antes do rerun do clique
+            c_btn1.button(f"Aprovar ({len(ids_sel)})", type="primary", disabled=not ids_sel, use_container_width=True,
+                          on_click=aplicar_status_aprovacao, args=(ids_sel, "Aprovado"))
+            c_btn2.button(f"Rejeitar ({len(ids_sel)})", type="secondary", disabled=not ids_sel, use_container_width=True,
+                          on_click=aplicar_status_aprovacao, args=(ids_sel, "Rejeitado"))
 
     # ==============================
     # ABA: Lançar Atividade (Barra de Progresso + Guia CORRIGIDA)
@@ -825,9 +1128,9 @@ else:
     elif aba == "Lançar Atividade":
         st.header("📝 Lançar Atividade")
         c1, c2 = st.columns(2)
-        mes_sel = c1.selectbox("Mês", MESES_SELECT, index=datetime.now().month)
-        ano_sel = c2.selectbox("Ano", ANOS, index=ANOS.index(datetime.now().year))
-        mes_num = next((k for k,v in MESES.items() if v == mes_sel), None)
+        mes_sel = c1.selectbox("Mês", MESES_SELECT, index=hoje.month)
+        ano_sel = c2.selectbox("Ano", ANOS, index=ANO_ATUAL_IDX)
+        mes_num = MESES_INV.get(mes_sel)
         
         if not mes_num: st.stop()
         
@@ -890,38 +1193,27 @@ else:
                 
                 total_novo_val = sum(n['val'] for n in validos)
                 
-                salvo_ok = False
                 if tipo == "Horas":
-                    # No modo Horas, o recalculo ocorre em salvar_atividade
+                    # No modo Horas, o recalculo ocorre em salvar_atividades_em_massa
                     total_h_final = horas_existentes + total_novo_val
                     if total_h_final == 0: 
                         st.error("Total de horas é zero.")
                         st.stop()
                         
-                    for n in validos:
-                        # O percentual é temporário (vai ser corrigido por ajustar_arredondamento_horas)
-                        perc_est = int(round((n['val']/total_h_final)*100)) 
-                        obs = f"[HORA:{n['val']}|{n['obs']}]"
-                        if salvar_atividade(st.session_state["usuario"], mes_num, ano_sel, n['desc'], n['proj'], perc_est, obs):
-                            salvo_ok = True
-                        else:
-                            salvo_ok = False # Se falhar, marca para erro
-                            break
+                    # O percentual é temporário (vai ser corrigido por ajustar_arredondamento_horas)
+                    linhas = [(n['desc'], n['proj'], int(round((n['val']/total_h_final)*100)), f"[HORA:{n['val']}|{n['obs']}]") for n in validos]
+                    salvo_ok = salvar_atividades_em_massa(st.session_state["usuario"], mes_num, ano_sel, linhas)
 
                 else:
                     if total_existente + total_novo_val > 100:
                         st.error("Ultrapassa 100%.")
                         st.stop()
                     
-                    for n in validos:
-                        if salvar_atividade(st.session_state["usuario"], mes_num, ano_sel, n['desc'], n['proj'], int(n['val']), n['obs']):
-                            salvo_ok = True
-                        else:
-                            salvo_ok = False
-                            break
+                    linhas = [(n['desc'], n['proj'], int(n['val']), n['obs']) for n in validos]
+                    salvo_ok = salvar_atividades_em_massa(st.session_state["usuario"], mes_num, ano_sel, linhas, limite=100)
                 
                 if salvo_ok:
-                    # O cache já foi limpo dentro de salvar_atividade
+                    # O cache já foi limpo dentro de salvar_atividades_em_massa
                     st.success("Salvo e recalculado!")
                     st.rerun()
                 else:
@@ -941,109 +1233,7 @@ else:
     # ABA: Minhas Atividades
     # ==============================
     elif aba == "Minhas Atividades":
-        st.header("📋 Minhas Atividades")
-        c1, c2 = st.columns(2)
-        mes_sel = c1.selectbox("Mês", MESES_SELECT, index=datetime.now().month, key="m_a")
-        ano_sel = c2.selectbox("Ano", ANOS, index=ANOS.index(datetime.now().year), key="a_a")
-        mes_num = next(k for k,v in MESES.items() if v == mes_sel)
-        
-        atividades = carregar_atividades_usuario(st.session_state["usuario"], mes_num, ano_sel)
-        ativas = [a for a in atividades if a['status'] != 'Rejeitado']
-        total = sum(a['porcentagem'] for a in ativas)
-        
-        col_met, col_graph = st.columns([1, 2])
-        col_met.metric("Total Alocado", f"{total}%", f"{100-total}% restante")
-        
-        df_g = pd.DataFrame(ativas)
-        if not df_g.empty:
-            fig = px.pie(df_g, names='descricao', values='porcentagem', hole=0.5, color_discrete_sequence=SINAPSIS_PALETTE)
-            fig.update_layout(margin=dict(t=0, b=0, l=0, r=0), height=200)
-            col_graph.plotly_chart(fig, use_container_width=True)
-
-        st.markdown("---")
-        
-        c_copy, c_exp = st.columns(2)
-        if c_copy.button("Copiar Mês Anterior", use_container_width=True):
-            m_ant = mes_num - 1 if mes_num > 1 else 12
-            a_ant = ano_sel if mes_num > 1 else ano_sel - 1
-            antigos = carregar_atividades_usuario(st.session_state["usuario"], m_ant, a_ant)
-            if antigos:
-                for a in antigos:
-                    # Chamada a salvar_atividade que já limpa o cache.
-                    salvar_atividade(st.session_state["usuario"], mes_num, ano_sel, a['descricao'], a['projeto'], a['porcentagem'], a['observacao'])
-                st.rerun()
-        
-        if ativas:
-            df_ex = pd.DataFrame(ativas)
-            df_ex['observacao'] = df_ex['observacao'].apply(lambda x: extrair_hora_bruta(x)[1])
-            buffer = io.BytesIO()
-            df_ex.to_excel(buffer, index=False)
-            c_exp.download_button("Exportar Excel", buffer, "atividades.xlsx", use_container_width=True)
-
-        st.subheader("Edição")
-        
-        cols_head = st.columns([0.5, 3, 3, 1.5, 2.5, 1.5])
-        cols_head[0].markdown("**ID**")
-        cols_head[1].markdown("**Descrição**")
-        cols_head[2].markdown("**Projeto**")
-        cols_head[3].markdown("**%**")
-        cols_head[4].markdown("**Obs**")
-        cols_head[5].markdown("**Ações**")
-        st.markdown("<hr style='margin: 5px 0;'>", unsafe_allow_html=True)
-
-        for a in atividades:
-            h_bruta, obs_clean = extrair_hora_bruta(a.get('observacao', ''))
-            disabled = a['status'] != 'Pendente'
-            
-            with st.form(key=f"f_row_{a['id']}"):
-                c_id, c_desc, c_proj, c_perc, c_obs, c_act = st.columns([0.5, 3, 3, 1.5, 2.5, 1.5])
-                
-                c_id.markdown(f"<div style='padding-top: 10px;'>{a['id']}</div>", unsafe_allow_html=True)
-                
-                with c_desc:
-                    nd = st.selectbox("d", DESCRICOES_SELECT, index=DESCRICOES_SELECT.index(a['descricao']) if a['descricao'] in DESCRICOES_SELECT else 0, key=f"d_{a['id']}", label_visibility="collapsed", disabled=disabled)
-                with c_proj:
-                    np = st.selectbox("p", PROJETOS_SELECT, index=PROJETOS_SELECT.index(a['projeto']) if a['projeto'] in PROJETOS_SELECT else 0, key=f"p_{a['id']}", label_visibility="collapsed", disabled=disabled)
-                with c_perc:
-                    nv = st.number_input("%", value=int(a['porcentagem']), min_value=0, max_value=100, key=f"v_{a['id']}", label_visibility="collapsed", disabled=disabled or h_bruta > 0, help="Desabilitado no modo horas.")
-                with c_obs:
-                    no = st.text_input("o", value=obs_clean, key=f"o_{a['id']}", label_visibility="collapsed", disabled=disabled)
-                
-                with c_act:
-                    st.markdown(f'<span class="status-badge status-{a["status"]}">{a["status"]}</span>', unsafe_allow_html=True)
-                    
-                    cb1, cb2 = st.columns(2)
-                    with cb1:
-                        btn_salvar = st.form_submit_button("💾", disabled=disabled, use_container_width=True, help="Salvar")
-                    with cb2:
-                        # O delete é uma função sem form, pois precisa ser acionado fora do submit
-                        btn_excluir = st.form_submit_button("🗑️", use_container_width=True, help="Excluir")
-
-                if btn_salvar:
-                    exc = calcular_porcentagem_existente(st.session_state["usuario"], mes_num, ano_sel, excluido_id=a['id'])
-                    
-                    perc_final = nv
-                    if h_bruta > 0:
-                        perc_final = a['porcentagem']
-                    elif exc + nv > 100:
-                        st.toast("Erro: > 100%", icon="❌")
-                        st.stop()
-                        
-                    obs_final = f"[HORA:{h_bruta}|{no}]" if h_bruta > 0 else no
-                    actual_update_ok = atualizar_atividade_completa(a['id'], nd, np, perc_final, obs_final)
-                    
-                    if actual_update_ok:
-                        # O cache já foi limpo dentro de atualizar_atividade_completa
-                        st.toast("Atualizado!", icon="✅")
-                        st.rerun()
-                    else:
-                        st.toast("Erro ao salvar!", icon="❌")
-                
-                if btn_excluir:
-                    # Chamada fora do if not btn_salvar para garantir que ele é o único acionado
-                    handle_delete(a['id'])
-
-                st.markdown("<hr style='margin: 5px 0; border-top: 1px solid #eee;'>", unsafe_allow_html=True)
+        minhas_atividades(st.session_state["usuario"], hoje)
 
     # ==============================
     # ABA: Importar Dados
@@ -1060,18 +1250,10 @@ else:
         if up:
             try:
                 if up.name.endswith('.csv'):
-                    df = pd.read_csv(up, sep=None, engine='python')
+                    df = ler_csv_importacao(up)
                 else:
                     df = pd.read_excel(up)
                 
-                # --- NOVO TRATAMENTO DE VÍRGULA DECIMAL ---
-                if 'Porcentagem' in df.columns:
-                    # Se Pandas leu como string (object), corrige a vírgula
-                    if df['Porcentagem'].dtype == object:
-                        df['Porcentagem'] = df['Porcentagem'].astype(str).str.replace('.', '', regex=False).str.replace(',', '.', regex=False)
-                        df['Porcentagem'] = pd.to_numeric(df['Porcentagem'], errors='coerce')
-                # ------------------------------------------
-                
                 map_cols = {'Nome': 'usuario', 'Data': 'data', 'Descrição': 'descricao', 'Projeto': 'projeto', 'Porcentagem': 'porcentagem', 'Observação (Opcional)': 'observacao'}
                 df.columns = df.columns.str.strip()
                 cols_existentes = {c: c for c in df.columns}
@@ -1093,33 +1275,44 @@ else:
                 if not st.session_state["admin"]:
                     df['usuario'] = st.session_state["usuario"]
                 
-                df['data'] = pd.to_datetime(df['data'], errors='coerce', dayfirst=True)
-                df.dropna(subset=['data', 'usuario', 'porcentagem'], inplace=True)
-                df['mes'] = df['data'].dt.month
-                df['ano'] = df['data'].dt.year
-                
-                if df['porcentagem'].max() <= 1.0: df['porcentagem'] = (df['porcentagem'] * 100)
-                df['porcentagem'] = df['porcentagem'].astype(int)
-
-                if 'observacao' not in df.columns: df['observacao'] = ''
-                df['observacao'] = df['observacao'].fillna('').astype(str)
-                df['status'] = 'Pendente'
-                df['descricao'] = df['descricao'].astype(str).str.strip()
-                df['projeto'] = df['projeto'].astype(str).str.strip()
+                # Vírgula decimal: coluna lida como texto (object ou string do pandas 3) vira número
+                pct = df['porcentagem']
+                if not pd.api.types.is_numeric_dtype(pct):
+                    pct = pd.to_numeric(pct.astype(str).str.replace('.', '', regex=False).str.replace(',', '.', regex=False), errors='coerce')
+                df = df.assign(data=converter_datas_importacao(df['data']), porcentagem=pct)
+                df = df.dropna(subset=['data', 'usuario', 'porcentagem'])
+
+                pct = df['porcentagem'] * 100 if df['porcentagem'].max() <= 1.0 else df['porcentagem']
+                df = df.assign(
+                    mes=df['data'].dt.month,
+                    ano=df['data'].dt.year,
+                    porcentagem=pct.round().astype(int), # round: 0,29 * 100 = 28,999... não pode virar 28
+                    observacao=df['observacao'].fillna('').astype(str) if 'observacao' in df.columns else '',
+                    status='Pendente',
+                    descricao=df['descricao'].astype(str).str.strip(),
+                    projeto=df['projeto'].astype(str).str.strip(),
+                )
 
                 st.markdown("### 🔍 Validação")
                 erros_validacao = False
-                desc_inv = df[~df['descricao'].isin(DESCRICOES)]
+                desc_inv = df[~df['descricao'].isin(DESCRICOES_SET)]
                 if not desc_inv.empty:
                     st.error("❌ Descrições inválidas")
                     st.dataframe(desc_inv['descricao'].unique())
                     erros_validacao = True
 
-                proj_inv = df[~df['projeto'].isin(PROJETOS)]
+                proj_inv = df[~df['projeto'].isin(PROJETOS_SET)]
                 if not proj_inv.empty:
                     st.error("❌ Projetos inválidos")
                     st.dataframe(proj_inv['projeto'].unique())
                     erros_validacao = True
+
+                # Nomes da planilha (modo admin) precisam já ser usuários: a importação não cria contas
+                usr_inv = df[~df['usuario'].isin(usuarios_df['usuario'])]
+                if not usr_inv.empty:
+                    st.error("❌ Usuários não cadastrados")
+                    st.dataframe(usr_inv['usuario'].unique())
+                    erros_validacao = True
                 
                 if erros_validacao: st.stop()
                 
@@ -1127,8 +1320,7 @@ else:
                 st.dataframe(df.head())
                 
                 if st.button("Confirmar Importação", type="primary"):
-                    df_exist = atividades_df[atividades_df['status'] != 'Rejeitado']
-                    tot_ex = df_exist.groupby(['usuario','mes','ano'])['porcentagem'].sum().reset_index().rename(columns={'porcentagem':'existente'})
+                    tot_ex = carregar_totais_ativos(df['usuario'].unique().tolist())
                     tot_new = df.groupby(['usuario','mes','ano'])['porcentagem'].sum().reset_index().rename(columns={'porcentagem':'novo'})
                     merged = pd.merge(tot_ex, tot_new, on=['usuario','mes','ano'], how='outer').fillna(0)
                     
@@ -1154,46 +1346,50 @@ else:
     # ==============================
     elif aba == "Consolidado" and st.session_state["admin"]:
         st.header("📑 Consolidado")
+        atividades_df = carregar_ou_parar(carregar_atividades)
         if atividades_df.empty:
             st.info("Vazio.")
         else:
             c1, c2, c3 = st.columns(3)
-            u_sel = c1.selectbox("Usuário", ["Todos"] + sorted(atividades_df['usuario'].unique()))
-            atividades_df['m_a'] = atividades_df['data'].dt.strftime('%Y-%m')
-            m_sel = c2.selectbox("Mês", ["Todos"] + sorted(atividades_df['m_a'].unique(), reverse=True))
+            # Categorias do COPY já vêm ordenadas e só com usuários presentes
+            u_sel = c1.selectbox("Usuário", ["Todos", *atividades_df['usuario'].cat.categories])
+            # Mês como inteiro AAAAMM, já vindo da carga; texto só para os rótulos únicos
+            m_a = atividades_df['mes_ano']
+            meses_opcoes = {f"{m // 100}-{m % 100:02d}": m for m in sorted(m_a.unique(), reverse=True)}
+            m_sel = c2.selectbox("Mês", ["Todos", *meses_opcoes])
             s_sel = c3.selectbox("Status", ["Todos", "Pendente", "Aprovado", "Rejeitado"])
             
-            df_f = atividades_df.copy()
-            if u_sel != "Todos": df_f = df_f[df_f['usuario'] == u_sel]
-            if m_sel != "Todos": df_f = df_f[df_f['m_a'] == m_sel]
-            if s_sel != "Todos": df_f = df_f[df_f['status'] == s_sel]
-
-            # Renomeia colunas para exportação
-            df_export = df_f.drop(columns=['m_a', 'id', 'observacao']).rename(columns={
-                'usuario': 'Usuário',
-                'data': 'Data',
-                'mes': 'Mês',
-                'ano': 'Ano',
-                'descricao': 'Descrição',
-                'projeto': 'Projeto',
-                'porcentagem': 'Porcentagem (%)',
-                'status': 'Status'
-            })
+            filtro = pd.Series(True, index=atividades_df.index)
+            if u_sel != "Todos": filtro &= atividades_df['usuario'] == u_sel
+            if m_sel != "Todos": filtro &= m_a == meses_opcoes[m_sel]
+            if s_sel != "Todos": filtro &= atividades_df['status'] == s_sel
+            df_f = atividades_df[filtro]
+
+            # factorize (hash em C) + bincount (uma passada): sem o custo fixo por grupo do groupby
+            codigos, meses = pd.factorize(m_a[filtro], sort=True)
+            totais_mes = np.bincount(codigos, weights=df_f['porcentagem'].to_numpy(), minlength=len(meses))
+            st.plotly_chart(grafico_total_mensal(tuple(f"{m // 100}-{m % 100:02d}" for m in meses), tuple(totais_mes.astype(int).tolist())), use_container_width=True)
             
-            st.plotly_chart(px.bar(df_f.groupby('m_a')['porcentagem'].sum().reset_index(), x='m_a', y='porcentagem', title="Total Alocado"), use_container_width=True)
-            
-            st.dataframe(df_f.drop(columns=['m_a']), use_container_width=True, hide_index=True)
+            if len(df_f) > CONSOLIDADO_MAX_LINHAS:
+                st.caption(f"{len(df_f)} linhas — mostrando as {CONSOLIDADO_MAX_LINHAS} mais recentes (a exportação traz todas).")
+            st.dataframe(df_f.head(CONSOLIDADO_MAX_LINHAS), use_container_width=True, hide_index=True, height=420, column_config={'mes_ano': None})
 
-            # Botão de Exportação para Excel (Consolidado)
-            buffer = io.BytesIO()
-            df_export.to_excel(buffer, index=False, sheet_name='Consolidado')
-            buffer.seek(0)
-            
+            # Botão de Exportação para Excel (Consolidado); colunas renomeadas na escrita
             st.download_button(
                 label="⬇️ Exportar Tabela Filtrada para Excel",
-                data=buffer,
-                file_name=f"consolidado_{datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx",
-                mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                data=excel_sob_demanda(df_f, 'Consolidado', {
+                    'usuario': 'Usuário',
+                    'data': 'Data',
+                    'mes': 'Mês',
+                    'ano': 'Ano',
+                    'descricao': 'Descrição',
+                    'projeto': 'Projeto',
+                    'porcentagem': 'Porcentagem (%)',
+                    'status': 'Status'
+                }),
+                file_name=f"consolidado_{hoje.strftime('%Y%m%d_%H%M%S')}.xlsx",
+                mime=MIME_XLSX,
+                on_click="ignore",
                 use_container_width=True
             )
 